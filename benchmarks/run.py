@@ -0,0 +1,234 @@
+"""
+Benchmark suite of the send and verify hot paths, run on an in-memory SQLite database with the locmem email backend.
+
+Covers URL resolution and view throughput at different URLconf sizes, token creation and checking at different user
+table sizes (with the length of each token format), the tokens per second of each JWT signer, cached and uncached
+template rendering, single and bulk sends. The results are printed and saved as JSON, pass a previous result file to
+--compare to print the ratio against it.
+
+Usage:
+    python benchmarks/run.py [--quick] [--output results.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import types
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_email_verification.tests.settings')
+
+from django.conf import settings  # noqa: E402
+
+settings.DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+settings.DEBUG = False
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core import mail  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.template import Context, Template  # noqa: E402
+from django.template.loader import render_to_string  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.urls import include, path, resolve  # noqa: E402
+
+from django_email_verification import send_email, send_email_bulk, urls, verify_email  # noqa: E402
+from django_email_verification.confirm import _resolve_link_prefixes, get_link_prefixes, render_templates  # noqa: E402
+from django_email_verification.signing import HMACSigner, PyJWTSigner  # noqa: E402
+from django_email_verification.token_utils import default_token_generator as generator  # noqa: E402
+
+URLCONF_SIZES = (10, 100, 1000)
+USER_TABLE_SIZES = (100, 10000)
+QUICK_URLCONF_SIZES = (10, 100)
+QUICK_USER_TABLE_SIZES = (100, 1000)
+BULK_SIZE = 100
+
+results = []
+
+
+def bench(name, fn, number, repeat=3, **params):
+    """
+    Time fn, keeping the best of the repeats, and store the result.
+    """
+    fn()
+    best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+    results.append({'name': name, 'params': params, 'us_per_op': best * 1e6, 'ops_per_sec': 1 / best})
+    label = ' '.join(f'{k}={v}' for k, v in params.items())
+    print(f'{name:>24} {label:<28} {best * 1e6:10.1f} us/op {1 / best:10.0f} ops/s')
+
+
+def make_urlconf(size):
+    # size - 1 unrelated routes before the ones of the app, the worst case for a linear resolver
+    module = types.ModuleType(f'benchmark_urls_{size}')
+    module.urlpatterns = [path(f'page_{i}/<slug:slug>/', lambda request, slug: None) for i in range(size - 1)]
+    module.urlpatterns.append(path('confirm/', include(urls)))
+    sys.modules[module.__name__] = module
+    return module.__name__
+
+
+def fill_users(size):
+    user_model = get_user_model()
+    count = user_model.objects.count()
+    user_model.objects.bulk_create([user_model(username=f'bench_{i}', email=f'bench_{i}@example.com')
+                                    for i in range(count, size)], batch_size=1000)
+    return user_model.objects.get(username=f'bench_{size // 2}')
+
+
+def bench_urls(sizes, number):
+    for size in sizes:
+        with override_settings(ROOT_URLCONF=make_urlconf(size)):
+            def uncached():
+                _resolve_link_prefixes.cache_clear()
+                return get_link_prefixes('MAIL')
+
+            bench('link_prefix_uncached', uncached, number // 10 or 1, urlconf=size)
+            bench('link_prefix_cached', lambda: get_link_prefixes('MAIL'), number, urlconf=size)
+            bench('resolve_verify_link', lambda: resolve('/confirm/email/token'), number, urlconf=size)
+
+
+def bench_tokens(sizes, number):
+    for size in sizes:
+        user = fill_users(size)
+        exp = int(generator.now()) + 3600
+        for token_format in ('jwt', 'compact'):
+            with override_settings(EMAIL_TOKEN_FORMAT=token_format):
+                token, _ = generator.make_token(user, exp, kind='MAIL')
+                assert generator.check_token(token, kind='MAIL')[0]
+                bench('make_token', lambda: generator.make_token(user, exp, kind='MAIL'), number,
+                      format=token_format, users=size)
+                results[-1]['token_length'] = len(token)
+                # the signature and payload checks alone, without the user lookup
+                bench('check_payload', lambda: generator._check_payload(token, kind='MAIL'), number,
+                      format=token_format, users=size)
+                bench('check_token', lambda: generator.check_token(token, kind='MAIL'), number // 10,
+                      format=token_format, users=size)
+                bench('verify_email', lambda: verify_email(token), number // 10, format=token_format, users=size)
+
+
+def bench_signers(number):
+    # encode and decode of a JWT payload by each signer, ops/s are tokens per second
+    keyring = generator.get_keyring()
+    payload = {'email': 'bench@example.com', 'exp': int(generator.now()) + 3600, 'jti': 'x' * 12, 'kind': 'MAIL'}
+    for name, signer in (('pyjwt', PyJWTSigner()), ('hmac', HMACSigner())):
+        for algorithm in ('HS256', 'HS512'):
+            token = signer.encode(payload, keyring, algorithm)
+            assert signer.decode(token, keyring, algorithm) == payload
+            bench('sign_token', lambda: signer.encode(payload, keyring, algorithm), number * 5,
+                  signer=name, algorithm=algorithm)
+            bench('decode_token', lambda: signer.decode(token, keyring, algorithm), number * 5,
+                  signer=name, algorithm=algorithm)
+
+
+def bench_render(number):
+    user = get_user_model()(username='bench_user', email='bench@example.com')
+    context = {'token': 'x' * 150, 'expiry': None, 'user': user, 'link': 'https://example.com/confirm/email/x'}
+
+    def cached():
+        return render_templates(settings.EMAIL_MAIL_SUBJECT, settings.EMAIL_MAIL_PLAIN, settings.EMAIL_MAIL_HTML,
+                                context)
+
+    def uncached():
+        # the rendering path before the templates were cached: compiled and looked up for every message
+        subject = Template(settings.EMAIL_MAIL_SUBJECT).render(Context(context))
+        return subject, render_to_string(settings.EMAIL_MAIL_PLAIN, context), \
+            render_to_string(settings.EMAIL_MAIL_HTML, context)
+
+    assert cached() == uncached()
+    bench('render_templates', cached, number)
+    bench('render_templates_uncached', uncached, number)
+
+
+def bench_send(number):
+    user = fill_users(BULK_SIZE)
+    users = list(get_user_model().objects.all()[:BULK_SIZE])
+
+    def send():
+        send_email(user, thread=False)
+        mail.outbox.clear()
+
+    def send_bulk():
+        send_email_bulk(users)
+        mail.outbox.clear()
+
+    bench('send_email', send, number // 10)
+    with override_settings(EMAIL_SAVE_USER=False):
+        bench('send_email_no_save', send, number // 10)
+        bench('send_email_bulk', send_bulk, 1, users=BULK_SIZE)
+    results[-1]['messages_per_sec'] = results[-1]['ops_per_sec'] * BULK_SIZE
+
+
+def bench_views(sizes, number):
+    user = fill_users(BULK_SIZE)
+    token, _ = generator.make_token(user, int(generator.now()) + 3600, kind='MAIL')
+    client = Client()
+    for size in sizes:
+        with override_settings(ROOT_URLCONF=make_urlconf(size)):
+            assert client.get(f'/confirm/email/{token}').status_code == 200
+            bench('verify_view', lambda: client.get(f'/confirm/email/{token}'), number // 10, urlconf=size)
+            bench('verify_view_invalid', lambda: client.get('/confirm/email/invalid'), number // 10, urlconf=size)
+
+
+def compare(previous):
+    with open(previous) as f:
+        old = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    print(f'\nCompared to {previous} (>1 is faster):')
+    for r in results:
+        key = (r['name'], json.dumps(r['params'], sort_keys=True))
+        if key in old:
+            print(f'{r["name"]:>24} {json.dumps(r["params"]):<40} {old[key]["us_per_op"] / r["us_per_op"]:6.2f}x')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and fewer iterations')
+    parser.add_argument('--output', default='benchmark_results.json', help='the JSON file to write')
+    parser.add_argument('--compare', help='a previous JSON result file')
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    number = 200 if args.quick else 2000
+    url_sizes = QUICK_URLCONF_SIZES if args.quick else URLCONF_SIZES
+    user_sizes = QUICK_USER_TABLE_SIZES if args.quick else USER_TABLE_SIZES
+
+    start = time.perf_counter()
+    bench_urls(url_sizes, number)
+    bench_render(number)
+    bench_send(number)
+    bench_views(url_sizes, number)
+    bench_tokens(user_sizes, number)
+    bench_signers(number)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'date': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'duration': time.perf_counter() - start,
+            'results': results,
+        }, f, indent=2)
+    print(f'\nResults saved to {args.output}')
+    if args.compare:
+        compare(args.compare)
+
+
+if __name__ == '__main__':
+    main()
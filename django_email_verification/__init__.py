@@ -1,4 +1,27 @@
-from .confirm import send_email, send_password, verify_email, verify_password, verify_token, verify_email_view, \
-    verify_password_view, verify_view
-from .views import verify_email_page, verify_password_page
-from .token_utils import default_token_generator
+# The public names are imported on first use, so that loading the app (and every management command) does not pull
+# in the token, template and mail dependencies
+_LAZY_NAMES = {
+    'confirm': ('send_email', 'send_password', 'send_email_bulk', 'send_password_bulk', 'verify_email',
+                'verify_password', 'verify_token', 'verify_email_view', 'verify_password_view', 'verify_view',
+                'asend_email', 'asend_password', 'averify_email', 'averify_password', 'SendResult', 'wait',
+                'as_completed', 'verify_email_bulk'),
+    'views': ('verify_email_page', 'verify_password_page', 'averify_email_page', 'averify_password_page'),
+    'token_utils': ('default_token_generator',),
+}
+_MODULES = {name: module for module, names in _LAZY_NAMES.items() for name in names}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from importlib import import_module
+    value = getattr(import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class DjangoEmailConfirmConfig(AppConfig):
     name = 'django_email_verification'
+    default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        from .conf import get_config
+        get_config()
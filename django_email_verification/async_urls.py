@@ -0,0 +1,15 @@
+from django.urls import path
+
+from .views import averify_email_page, averify_password_page
+
+
+def _csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt wraps async views in a sync function before Django 5.0
+    view.csrf_exempt = True
+    return view
+
+
+urlpatterns = [
+    path('email/<str:token>', _csrf_exempt(averify_email_page)),
+    path('password/<str:token>', _csrf_exempt(averify_password_page)),
+]
@@ -0,0 +1,226 @@
+from collections.abc import Callable
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Optional
+
+from django.conf import settings
+from django.core import checks
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+KINDS = ('MAIL', 'PASSWORD')
+TOKEN_FORMATS = ('jwt', 'compact')
+# the keys are HMAC secrets, so only the HMAC algorithms can sign the tokens
+TOKEN_ALGORITHMS = ('HS256', 'HS384', 'HS512')
+QUEUE_POLICIES = ('block', 'drop', 'raise')
+# link previews and mail security scanners, which open the links without a user
+PREFETCH_USER_AGENTS = ('BingPreview', 'Microsoft Office', 'SkypeUriPreview', 'Slackbot', 'facebookexternalhit',
+                        'WhatsApp', 'TelegramBot', 'Discordbot', 'LinkedInBot', 'Twitterbot', 'Googlebot',
+                        'Barracuda', 'Proofpoint', 'Mimecast')
+
+# attribute, setting, accepted types, default (None if required)
+GLOBAL_FIELDS = (
+    ('from_address', 'EMAIL_FROM_ADDRESS', str, None),
+    ('page_domain', 'EMAIL_PAGE_DOMAIN', str, ''),
+    ('page_scheme', 'EMAIL_PAGE_SCHEME', str, 'https'),
+    ('debug', 'DEBUG', bool, False),
+    ('multi_user', 'EMAIL_MULTI_USER', bool, False),
+    ('save_user', 'EMAIL_SAVE_USER', (bool, list, tuple), True),
+    ('outbox', 'EMAIL_OUTBOX', bool, False),
+    ('outbox_batch_size', 'EMAIL_OUTBOX_BATCH_SIZE', int, 100),
+    ('outbox_max_attempts', 'EMAIL_OUTBOX_MAX_ATTEMPTS', int, 5),
+    ('outbox_backoff', 'EMAIL_OUTBOX_BACKOFF', int, 60),
+    ('bulk_chunk_size', 'EMAIL_BULK_CHUNK_SIZE', int, 100),
+    ('transport', 'EMAIL_TRANSPORT', str, None),
+    ('transport_options', 'EMAIL_TRANSPORT_OPTIONS', dict, None),
+    ('rate_limits', 'EMAIL_RATE_LIMITS', dict, None),
+    ('rate_limit_cache', 'EMAIL_RATE_LIMIT_CACHE', str, 'default'),
+    ('dedup_window', 'EMAIL_DEDUP_WINDOW', int, 0),
+    ('metrics_hook', 'EMAIL_METRICS_HOOK', str, None),
+    ('send_workers', 'EMAIL_SEND_WORKERS', int, 4),
+    ('send_queue_size', 'EMAIL_SEND_QUEUE_SIZE', int, 1000),
+    ('send_queue_policy', 'EMAIL_SEND_QUEUE_POLICY', str, 'block'),
+    ('send_drain_on_sigterm', 'EMAIL_SEND_DRAIN_ON_SIGTERM', bool, True),
+    ('send_drain_timeout', 'EMAIL_SEND_DRAIN_TIMEOUT', (int, float), None),
+    ('send_retries', 'EMAIL_SEND_RETRIES', int, 3),
+    ('send_retry_backoff', 'EMAIL_SEND_RETRY_BACKOFF', (int, float), 1),
+    ('send_retry_max_backoff', 'EMAIL_SEND_RETRY_MAX_BACKOFF', (int, float), 60),
+    ('send_circuit_threshold', 'EMAIL_SEND_CIRCUIT_THRESHOLD', int, 5),
+    ('send_circuit_reset', 'EMAIL_SEND_CIRCUIT_RESET', (int, float), 30),
+    ('token_format', 'EMAIL_TOKEN_FORMAT', str, 'jwt'),
+    ('token_accepted_formats', 'EMAIL_TOKEN_ACCEPTED_FORMATS', (list, tuple), TOKEN_FORMATS),
+    ('token_algorithm', 'EMAIL_TOKEN_ALGORITHM', str, 'HS256'),
+    ('token_signer', 'EMAIL_TOKEN_SIGNER', str, None),
+    ('token_keys', 'EMAIL_TOKEN_KEYS', (list, tuple), None),
+    ('key_salt', 'CUSTOM_SALT', str, 'django-email-verification.token'),
+    ('token_lookup_field', 'EMAIL_TOKEN_LOOKUP_FIELD', str, 'email'),
+    ('token_cache', 'EMAIL_TOKEN_CACHE', str, None),
+    ('token_negative_timeout', 'EMAIL_TOKEN_NEGATIVE_TIMEOUT', int, 60),
+    ('user_only_fields', 'EMAIL_USER_ONLY_FIELDS', (list, tuple), None),
+    ('user_select_related', 'EMAIL_USER_SELECT_RELATED', (list, tuple), None),
+    ('password_change_page_template', 'EMAIL_PASSWORD_CHANGE_PAGE_TEMPLATE', str, None),
+    ('mail_confirm_page_template', 'EMAIL_MAIL_CONFIRM_PAGE_TEMPLATE', str, None),
+    ('prefetch_user_agents', 'EMAIL_PREFETCH_USER_AGENTS', (list, tuple), PREFETCH_USER_AGENTS),
+    ('page_cache_timeout', 'EMAIL_PAGE_CACHE_TIMEOUT', int, 0),
+)
+
+# attribute, setting suffix, accepted types, required to send the email
+KIND_FIELDS = (
+    ('subject', 'SUBJECT', str, True),
+    ('html', 'HTML', str, True),
+    ('plain', 'PLAIN', str, True),
+    ('token_life', 'TOKEN_LIFE', int, True),
+    ('callback', 'CALLBACK', Callable, False),
+    ('page_template', 'PAGE_TEMPLATE', str, False),
+)
+
+CHOICES = {
+    'EMAIL_SEND_QUEUE_POLICY': QUEUE_POLICIES,
+    'EMAIL_TOKEN_FORMAT': TOKEN_FORMATS,
+    'EMAIL_TOKEN_ALGORITHM': TOKEN_ALGORITHMS,
+}
+
+
+class KindConfig(NamedTuple):
+    subject: Optional[str]
+    html: Optional[str]
+    plain: Optional[str]
+    token_life: Optional[int]
+    callback: Optional[Callable]
+    page_template: Optional[str]
+    missing: tuple
+
+
+class Config(NamedTuple):
+    """
+    The settings of the app, validated once. A missing or invalid required setting is None.
+    """
+    from_address: Optional[str]
+    page_domain: str
+    page_scheme: str
+    debug: bool
+    multi_user: bool
+    save_user: Any
+    outbox: bool
+    outbox_batch_size: int
+    outbox_max_attempts: int
+    outbox_backoff: int
+    bulk_chunk_size: int
+    transport: Optional[str]
+    transport_options: Optional[dict]
+    rate_limits: Optional[dict]
+    rate_limit_cache: str
+    dedup_window: int
+    metrics_hook: Optional[str]
+    send_workers: int
+    send_queue_size: int
+    send_queue_policy: str
+    send_drain_on_sigterm: bool
+    send_drain_timeout: Optional[float]
+    send_retries: int
+    send_retry_backoff: float
+    send_retry_max_backoff: float
+    send_circuit_threshold: int
+    send_circuit_reset: float
+    token_format: str
+    token_accepted_formats: tuple
+    token_algorithm: str
+    token_signer: Optional[str]
+    token_keys: Optional[tuple]
+    key_salt: str
+    token_lookup_field: str
+    token_cache: Optional[str]
+    token_negative_timeout: int
+    user_only_fields: Optional[tuple]
+    user_select_related: Optional[tuple]
+    password_change_page_template: Optional[str]
+    mail_confirm_page_template: Optional[str]
+    prefetch_user_agents: tuple
+    page_cache_timeout: int
+    kinds: Mapping[str, KindConfig]
+
+
+_config = None
+
+
+def get_config():
+    """
+    Returns:
+        (Config): the configuration, built from the settings on first use and after every setting change
+    """
+    global _config
+    config = _config
+    if config is None:
+        config = _config = build_config()
+    return config
+
+
+def build_config():
+    values = {attr: _get_validated_field(name, default, default_type) for attr, name, default_type, default in
+              GLOBAL_FIELDS}
+    kinds = {}
+    for kind in KINDS:
+        kind_values = {attr: _get_validated_field(f'EMAIL_{kind}_{suffix}', None, default_type)
+                       for attr, suffix, default_type, _ in KIND_FIELDS}
+        # the settings needed to send an email, the token life is not needed with a custom expiry
+        missing = ['EMAIL_FROM_ADDRESS'] if values['from_address'] is None else []
+        missing += [f'EMAIL_{kind}_{suffix}' for attr, suffix, _, _ in KIND_FIELDS
+                    if attr in ('subject', 'html', 'plain') and kind_values[attr] is None]
+        kinds[kind] = KindConfig(missing=tuple(missing), **kind_values)
+    values['kinds'] = MappingProxyType(kinds)
+    return Config(**values)
+
+
+def _get_validated_field(field, default, default_type):
+    d = getattr(settings, field, None)
+    if d == "" or d is None or not isinstance(d, default_type):
+        return default
+    return d
+
+
+@receiver(setting_changed)
+def _reset_config(**kwargs):
+    global _config
+    _config = None
+
+
+@checks.register()
+def check_settings(app_configs, **kwargs):
+    errors = []
+
+    def check(name, default_type):
+        d = getattr(settings, name, None)
+        if d == "" or d is None:
+            return False
+        if not isinstance(d, default_type):
+            errors.append(checks.Error(f'{name} has an invalid type {type(d).__name__}',
+                                       id='django_email_verification.E001'))
+        elif name in CHOICES and d not in CHOICES[name]:
+            errors.append(checks.Error(f'{name} must be one of {CHOICES[name]}', id='django_email_verification.E002'))
+        return True
+
+    for _, name, default_type, _ in GLOBAL_FIELDS:
+        check(name, default_type)
+
+    from .ratelimit import RATE_LIMIT_SCOPES, parse_rate
+    rate_limits = getattr(settings, 'EMAIL_RATE_LIMITS', None)
+    for scope, rate in (rate_limits.items() if isinstance(rate_limits, dict) else ()):
+        try:
+            if scope not in RATE_LIMIT_SCOPES:
+                raise ValueError(scope)
+            parse_rate(rate)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            errors.append(checks.Error(f'EMAIL_RATE_LIMITS has an invalid rate {scope!r}: {rate!r}',
+                                       id='django_email_verification.E003'))
+
+    if getattr(settings, 'EMAIL_FROM_ADDRESS', None) in ('', None):
+        errors.append(checks.Warning('EMAIL_FROM_ADDRESS missing, no email can be sent',
+                                     id='django_email_verification.W002'))
+
+    for kind in KINDS:
+        required = [f'EMAIL_{kind}_{suffix}' for _, suffix, default_type, needed in KIND_FIELDS
+                    if not check(f'EMAIL_{kind}_{suffix}', default_type) and needed]
+        if 0 < len(required) < sum(needed for *_, needed in KIND_FIELDS):
+            errors.append(checks.Warning(f'{", ".join(required)} missing, the {kind.lower()} emails cannot be sent',
+                                         id='django_email_verification.W001'))
+
+    return errors
@@ -1,97 +1,484 @@
+import asyncio
 import functools
 import logging
-from threading import Thread
-from typing import Callable
+from concurrent import futures
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
 
-import deprecation
-import validators
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.template import Template, Context
-from django.template.loader import render_to_string
-from django.urls import get_resolver
-
-from .errors import InvalidUserModel, NotAllFieldCompiled
+from django.template.loader import get_template
+from django.urls import get_resolver, get_urlconf
+from django.utils.autoreload import file_changed
+from django.utils.translation import get_language
+
+from .conf import get_config
+from .context import build_context
+from .errors import CircuitOpen, InvalidUserModel, NotAllFieldCompiled, PermanentSendError, SendQueueFull, \
+    TransientSendError, VerifyViewNotFound
+from .executor import Retry, get_executor
+from .metrics import get_metrics
+from .ratelimit import check_send, forget_send, get_outstanding, rate_limit_enabled, record_send
+from .retry import backend_replied, backoff_delay, classify_error, get_circuit_breaker
+from .signals import token_verified, verification_email_sent, verification_failed
 from .token_utils import default_token_generator
+from .transport import get_transport
 
 logger = logging.getLogger('django_email_verification')
 DJANGO_EMAIL_VERIFICATION_URL_ROUTE_ERROR = 'ERROR: no path found url.py'
 DJANGO_EMAIL_VERIFICATION_MORE_VIEWS_ERROR = 'ERROR: more than one verify view found'
 DJANGO_EMAIL_VERIFICATION_MALFORMED_URL = 'WARNING: the URL seems to be malformed'
+DJANGO_EMAIL_VERIFICATION_SEND_REJECTED = 'INFO: the email has not been sent'
+
+
+class SendResult:
+    """
+    The handle of an email passed to send_email() or send_password().
+
+    Attributes:
+        reason (str): why the email has been rejected by the rate limits or the dedup window, None otherwise
+        token (str): the token in the email, for a duplicate the one of the email already sent, None if it is not
+            known yet (the email is in the outbox) or could not be created
+        expiry (datetime): the expiry of the token
+        future (Future): completed with True when the email has been sent, False if it has been rejected, None if it
+            has been stored in the outbox, or with the SendError that made it fail after the retries
+    """
+    __slots__ = ('reason', 'future', 'token', 'expiry')
+
+    def __init__(self, reason, future, token=None, expiry=None):
+        self.reason = reason
+        self.future = future
+        self.token = token
+        self.expiry = expiry
+
+    @property
+    def rejected(self):
+        return self.reason is not None
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the email to be sent, raising its SendError if it fails.
+        """
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def __repr__(self):
+        state = f'rejected: {self.reason}' if self.rejected else self.future._state.lower()
+        return f'<SendResult {state}>'
+
+
+def wait(results, timeout=None, return_when=futures.ALL_COMPLETED):
+    """
+    Same as concurrent.futures.wait(), for the results of many sends.
+
+    Returns:
+        (tuple): the set of the results done and the set of those not done
+    """
+    by_future = {result.future: result for result in results}
+    done, not_done = futures.wait(by_future, timeout, return_when)
+    return {by_future[f] for f in done}, {by_future[f] for f in not_done}
+
 
+def as_completed(results, timeout=None):
+    """
+    Same as concurrent.futures.as_completed(), yields the results of many sends as they complete.
+    """
+    by_future = {result.future: result for result in results}
+    for future in futures.as_completed(by_future, timeout):
+        yield by_future[future]
 
-def send_email(user, thread=True, expiry=None, context=None):
-    send_inner(user, thread, expiry, 'MAIL', context)
 
+class BulkSendResult(NamedTuple):
+    user: Any
+    token: Optional[str]
+    expiry: Optional[datetime]
+    error: Optional[Exception]
 
-def send_password(user, thread=True, expiry=None, context=None):
-    send_inner(user, thread, expiry, 'PASSWORD', context)
 
+class BulkVerifyResult(NamedTuple):
+    token: str
+    success: bool
+    user: Any
 
-def send_inner(user, thread, expiry, kind, context=None):
+
+def send_email(user, thread=True, expiry=None, context=None, request=None):
+    return send_inner(user, thread, expiry, 'MAIL', context, request)
+
+
+def send_password(user, thread=True, expiry=None, context=None, request=None):
+    return send_inner(user, thread, expiry, 'PASSWORD', context, request)
+
+
+async def asend_email(user, thread=True, expiry=None, context=None, request=None):
+    return await asend_inner(user, thread, expiry, 'MAIL', context, request)
+
+
+async def asend_password(user, thread=True, expiry=None, context=None, request=None):
+    return await asend_inner(user, thread, expiry, 'PASSWORD', context, request)
+
+
+def send_email_bulk(users, expiry=None, context=None, chunk_size=None):
+    return send_inner_bulk(users, expiry, 'MAIL', context, chunk_size)
+
+
+def send_password_bulk(users, expiry=None, context=None, chunk_size=None):
+    return send_inner_bulk(users, expiry, 'PASSWORD', context, chunk_size)
+
+
+def send_inner(user, thread, expiry, kind, context=None, request=None):
+    """
+    Returns:
+        (SendResult): the reason the email has been rejected, or the future of its delivery
+    """
+    future = Future()
+    args = None
     try:
-        user.save()
-
-        exp = expiry if expiry is not None else _get_validated_field(f'EMAIL_{kind}_TOKEN_LIFE',
-                                                                     default_type=int) + default_token_generator.now()
-        token, expiry = default_token_generator.make_token(user, exp, kind=kind)
-
-        sender = _get_validated_field('EMAIL_FROM_ADDRESS')
-        domain = _get_validated_field('EMAIL_PAGE_DOMAIN', default='', use_default=True)
-        subject = _get_validated_field(f'EMAIL_{kind}_SUBJECT')
-        mail_plain = _get_validated_field(f'EMAIL_{kind}_PLAIN')
-        mail_html = _get_validated_field(f'EMAIL_{kind}_HTML')
-        debug = _get_validated_field('DEBUG', default_type=bool)
-
-        args = (user, kind, token, expiry, sender, domain, subject, mail_plain, mail_html, debug, context)
-        if thread:
-            t = Thread(target=send_inner_thread, args=args)
-            t.start()
-        else:
-            send_inner_thread(*args)
-    except AttributeError:
-        raise InvalidUserModel('The user model you provided is invalid')
-    except NotAllFieldCompiled as e:
-        raise e
+        # the errors of the save and of the configuration are raised before the send is counted by the rate limits
+        if (save_kwargs := _get_save_kwargs(user)) is not None:
+            with get_metrics().timer('save', kind):
+                user.save(**save_kwargs)
+        expiry = _get_expiry(expiry, _get_kind_config(get_config(), kind), kind)
+
+        if (rejected := _check_send(user, kind, request)) is not None:
+            return rejected
+        if get_config().outbox:
+            return _store_in_outbox(user, expiry, kind, context)
+
+        args = _get_send_args(user, expiry, kind, context, get_page_domain(request))
+        record_send(user, kind, *args[2:4])
+        _dispatch(args, future, thread)
     except Exception as e:
-        logger.error(repr(e))
+        _send_error(user, kind, future, e)
+    return SendResult(None, future, *(args[2:4] if args is not None else ()))
 
 
-def send_inner_thread(user, kind, token, expiry, sender, domain, subject, mail_plain, mail_html, debug, context):
-    domain += '/' if not domain.endswith('/') else ''
+async def asend_inner(user, thread, expiry, kind, context=None, request=None):
+    # the same steps of send_inner(), with the blocking ones run by sync_to_async
+    future = Future()
+    args = None
+    try:
+        if (save_kwargs := _get_save_kwargs(user)) is not None:
+            with get_metrics().timer('save', kind):
+                await user.asave(**save_kwargs)
+        expiry = _get_expiry(expiry, _get_kind_config(get_config(), kind), kind)
+
+        limited = rate_limit_enabled()
+        if limited and (rejected := await sync_to_async(_check_send)(user, kind, request)) is not None:
+            return rejected
+        if get_config().outbox:
+            return await sync_to_async(_store_in_outbox)(user, expiry, kind, context)
+
+        # the current site may have to be fetched from the database
+        domain = get_config().page_domain or await sync_to_async(get_page_domain)(request)
+        args = _get_send_args(user, expiry, kind, context, domain)
+        if limited:
+            await sync_to_async(record_send)(user, kind, *args[2:4])
+        await sync_to_async(_dispatch, thread_sensitive=False)(args, future, thread)
+    except Exception as e:
+        await sync_to_async(_send_error)(user, kind, future, e)
+    return SendResult(None, future, *(args[2:4] if args is not None else ()))
 
-    if context is None:
-        context = {}
 
-    context.update({'token': token, 'expiry': expiry, 'user': user})
+def _check_send(user, kind, request):
+    if (reason := check_send(user, kind, request)) is None:
+        return None
+    logger.info(f'{DJANGO_EMAIL_VERIFICATION_SEND_REJECTED} - {reason}')
+    return SendResult(reason, _completed(False), *(get_outstanding(user, kind) or ()))
 
-    def has_decorator(k):
-        if callable(k):
-            return k.__dict__.get(f'django_email_verification_{kind.lower()}_view_id', False)
-        return False
 
-    d = [v[0][0] for k, v in get_resolver(None).reverse_dict.items() if has_decorator(k)]
-    d = [a[0][:a[0].index('%')] for a in d if len(a[1])]
+def _store_in_outbox(user, expiry, kind, context):
+    _get_outbox_model().objects.create(**_get_outbox_fields(user, expiry, kind, context))
+    record_send(user, kind)
+    return SendResult(None, _completed(None))
+
+
+def _dispatch(args, future, thread):
+    if thread:
+        if not get_executor().submit(_deliver, args, future):
+            _delivery_failed(args[0], args[1], future, TransientSendError('The send queue is full'))
+        return
+    try:
+        # a single attempt, the retries would wait in the caller's thread
+        _deliver(args, future, retries=0)
+    except Exception as e:
+        # already reported by _deliver
+        logger.error(repr(e))
+
+
+def _send_error(user, kind, future, error):
+    # the errors raised before the email reaches _deliver
+    if isinstance(error, AttributeError):
+        forget_send(user, kind)
+        raise InvalidUserModel('The user model you provided is invalid')
+    if isinstance(error, NotAllFieldCompiled):
+        raise error
+    if isinstance(error, SendQueueFull):
+        forget_send(user, kind)
+        raise error
+    logger.error(repr(error))
+    _delivery_failed(user, kind, future, classify_error(error))
+
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _get_save_kwargs(user):
+    save = get_config().save_user
+    if save is True or user._state.adding:
+        return {}
+    if save:
+        return {'update_fields': save}
+    return None
+
+
+def _get_kind_config(config, kind):
+    kind_config = config.kinds[kind]
+    if kind_config.missing:
+        raise NotAllFieldCompiled(f'Field {kind_config.missing[0]} missing or invalid')
+    return kind_config
+
+
+def _get_expiry(expiry, kind_config, kind):
+    if expiry is None:
+        if kind_config.token_life is None:
+            raise NotAllFieldCompiled(f'Field EMAIL_{kind}_TOKEN_LIFE missing or invalid')
+        return kind_config.token_life + default_token_generator.now()
+    return expiry
+
+
+def _get_send_args(user, expiry, kind, context, domain=None):
+    config = get_config()
+    kind_config = _get_kind_config(config, kind)
+    token, expiry = default_token_generator.make_token(user, _get_expiry(expiry, kind_config, kind), kind=kind)
+    if domain is None:
+        domain = get_page_domain()
+
+    return (user, kind, token, expiry, config.from_address, domain, kind_config.subject,
+            kind_config.plain, kind_config.html, config.debug, context, get_urlconf())
+
+
+def get_page_domain(request=None):
+    """
+    Return the domain of the links: EMAIL_PAGE_DOMAIN or, if it is not set and django.contrib.sites is installed,
+    the domain of the current site (by SITE_ID, or by the host of the request) with EMAIL_PAGE_SCHEME.
+    The sites are cached by Django, so the database is queried once per site.
+
+    Args:
+        request (HttpRequest): optional request, used to find the site if SITE_ID is not set
+
+    Returns:
+        (str): the domain, '' if it cannot be found
+    """
+    config = get_config()
+    if config.page_domain or not apps.is_installed('django.contrib.sites'):
+        return config.page_domain
+    if request is None and not getattr(settings, 'SITE_ID', None):
+        return config.page_domain
+    from django.contrib.sites.models import Site
+    return f'{config.page_scheme}://{Site.objects.get_current(request).domain}/'
+
+
+def _get_outbox_model():
+    from .models import OutboxEmail
+    return OutboxEmail
+
+
+def _get_outbox_fields(user, expiry, kind, context):
+    exp = _get_expiry(expiry, get_config().kinds[kind], kind)
+    exp = exp.timestamp() if isinstance(exp, datetime) else exp
+    return {'user_pk': str(user.pk), 'kind': kind, 'expiry': int(exp), 'context': context}
+
+
+def send_inner_thread(user, kind, token, expiry, sender, domain, subject, mail_plain, mail_html, debug, context,
+                      urlconf=None):
+    metrics = get_metrics()
+    with metrics.timer('total', kind):
+        with metrics.timer('resolve', kind):
+            link_prefix = _get_link_prefix(kind, domain, urlconf)
+        if link_prefix is None:
+            raise VerifyViewNotFound(f'No single verify view found for {kind}')
+
+        with metrics.timer('render', kind):
+            msg = _build_message(user, token, expiry, sender, link_prefix, subject, mail_plain, mail_html, debug,
+                                 context)
+        with metrics.timer('send', kind):
+            get_transport().send_messages([msg])
+
+
+def _deliver(args, future, attempt=0, retries=None):
+    """
+    An attempt to send an email, run by the send executor. It raises Retry if the email can be attempted again, at
+    most retries times (EMAIL_SEND_RETRIES by default).
+    """
+    user, kind, token, expiry = args[:4]
+    breaker = get_circuit_breaker()
+    try:
+        breaker.check()
+        send_inner_thread(*args)
+    except Exception as e:
+        error = classify_error(e)
+        if backend_replied(error):
+            # a refused recipient means that the backend is working, and it closes a half open circuit
+            breaker.success()
+        elif isinstance(error, TransientSendError) and not isinstance(error, CircuitOpen):
+            # a missing template does not mean that the backend is failing
+            breaker.failure()
+        config = get_config()
+        if retries is None:
+            retries = config.send_retries
+        if isinstance(error, TransientSendError) and attempt < retries:
+            get_metrics().increment('send_retry', kind)
+            delay = backoff_delay(attempt, config.send_retry_backoff, config.send_retry_max_backoff)
+            raise Retry(delay, (args, future, attempt + 1), lambda: _delivery_failed(user, kind, future, error))
+        _delivery_failed(user, kind, future, error)
+        raise error
+    breaker.success()
+    _sent(user, kind, token, expiry)
+    future.set_result(True)
+
+
+def _delivery_failed(user, kind, future, error):
+    # the email was not delivered, so it is not a duplicate of the next one
+    forget_send(user, kind)
+    _send_failed(user, kind, error)
+    if not future.done():
+        future.set_exception(error)
+
+
+def _sent(user, kind, token, expiry):
+    get_metrics().increment('sent', kind)
+    verification_email_sent.send(sender=type(user), user=user, kind=kind, token=token, expiry=expiry)
+
+
+def _send_failed(user, kind, error):
+    get_metrics().increment('send_failed', kind)
+    verification_failed.send(sender=type(user) if user is not None else None, user=user, kind=kind, stage='send',
+                             error=error)
+
+
+def send_inner_bulk(users, expiry, kind, context=None, chunk_size=None):
+    """
+    Send the emails of many users through a single connection of the email backend.
+
+    Args:
+        users (Iterable[Model]): the users
+        expiry (datetime | int): optional forced expiry date
+        kind (str): either 'MAIL' or 'PASSWORD'
+        context (dict | Callable): additional context for the email templates, shared by all the users (the shared
+            values are computed once for the whole send)
+        chunk_size (int): number of messages passed at once to send_messages()
+
+    Returns:
+        (list[BulkSendResult]): a result for each user, in the same order
+    """
+    config = get_config()
+    kind_config = _get_kind_config(config, kind)
+    if expiry is None:
+        # fail before sending anything if the token life is missing
+        _get_expiry(expiry, kind_config, kind)
+    if chunk_size is None:
+        chunk_size = config.bulk_chunk_size
+
+    link_prefix = _get_link_prefix(kind, get_page_domain(), get_urlconf())
+    if link_prefix is None:
+        error = VerifyViewNotFound(f'No single verify view found for {kind}')
+        results = [BulkSendResult(user, None, None, error) for user in users]
+        for result in results:
+            _send_failed(result.user, kind, error)
+        return results
+
+    results = []
+    chunk = []
+
+    with get_transport() as transport:
+        def flush():
+            try:
+                with get_metrics().timer('send', kind):
+                    transport.send_messages([msg for _, msg in chunk])
+            except Exception as e:
+                logger.error(repr(e))
+                for i, _ in chunk:
+                    results[i] = results[i]._replace(error=e)
+                    _send_failed(results[i].user, kind, e)
+            else:
+                for i, _ in chunk:
+                    _sent(results[i].user, kind, results[i].token, results[i].expiry)
+            chunk.clear()
+
+        for user in users:
+            try:
+                if (save_kwargs := _get_save_kwargs(user)) is not None:
+                    user.save(**save_kwargs)
+                token, exp = default_token_generator.make_token(user, _get_expiry(expiry, kind_config, kind),
+                                                                kind=kind)
+                msg = _build_message(user, token, exp, config.from_address, link_prefix, kind_config.subject,
+                                     kind_config.plain, kind_config.html, config.debug, context)
+            except Exception as e:
+                logger.error(repr(e))
+                results.append(BulkSendResult(user, None, None, e))
+                _send_failed(user, kind, e)
+                continue
+            results.append(BulkSendResult(user, token, exp, None))
+            chunk.append((len(results) - 1, msg))
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+
+    return results
+
+
+def _get_link_prefix(kind, domain, urlconf):
+    domain += '/' if not domain.endswith('/') else ''
+
+    d = get_link_prefixes(kind, urlconf)
 
     if len(d) == 0:
         logger.error(DJANGO_EMAIL_VERIFICATION_URL_ROUTE_ERROR)
-        return
+        return None
 
     if len(d) > 1:
         logger.error(f'{DJANGO_EMAIL_VERIFICATION_MORE_VIEWS_ERROR}: {d}')
-        return
+        return None
+
+    link_prefix = domain + d[0]
+    _check_link_prefix(link_prefix)
+    return link_prefix
 
-    if len(d) >= 1:
-        context['link'] = domain + d[0] + token
-        if not validators.url(context['link']):
-            logger.warning(f'{DJANGO_EMAIL_VERIFICATION_MALFORMED_URL} - {context["link"]}')
 
-    subject = Template(subject).render(Context(context))
+@functools.lru_cache(maxsize=32)
+def _check_link_prefix(link_prefix):
+    # the tokens are made only of URL safe characters (base64url and '.'), so the links of a prefix are all valid
+    # or all malformed and the prefix is checked just once
+    import validators
+    if not validators.url(link_prefix + 'token'):
+        logger.warning(f'{DJANGO_EMAIL_VERIFICATION_MALFORMED_URL} - {link_prefix}')
 
-    text = render_to_string(mail_plain, context)
 
-    html = render_to_string(mail_html, context)
+def _build_message(user, token, expiry, sender, link_prefix, subject, mail_plain, mail_html, debug, context):
+    context = build_context(context, user)
+    context.update({'token': token, 'expiry': expiry, 'user': user, 'link': link_prefix + token})
 
+    subject, text, html = render_templates(subject, mail_plain, mail_html, context)
+
+    from django.core.mail import EmailMultiAlternatives
     msg = EmailMultiAlternatives(subject, text, sender, [user.email])
 
     if debug:
@@ -99,75 +486,258 @@ def send_inner_thread(user, kind, token, expiry, sender, domain, subject, mail_p
         msg.extra_headers['TOKEN'] = token
 
     msg.attach_alternative(html, 'text/html')
-    msg.send()
+    return msg
 
 
-def _get_validated_field(field, default=None, use_default=False, default_type=None):
-    if default_type is None:
-        default_type = str
-    try:
-        d = getattr(settings, field)
-        if d == "" or d is None or not isinstance(d, default_type):
-            raise AttributeError(f'Wrong value for field {field}')
-        return d
-    except AttributeError:
-        if use_default:
-            return default
-        raise NotAllFieldCompiled(f'Field {field} missing or invalid')
+def render_templates(subject, mail_plain, mail_html, context):
+    """
+    Render the subject, plain and html templates of an email, compiling each of them only once.
+
+    Returns:
+        (tuple): the rendered subject, plain text and html
+    """
+    language = get_language()
+    subject = _get_subject_template(subject, language).render(Context(context))
+    text = _get_mail_template(mail_plain, language).render(context)
+    html = _get_mail_template(mail_html, language).render(context)
+    return subject, text, html
+
+
+@functools.lru_cache(maxsize=32)
+def _get_subject_template(subject, language):
+    return Template(subject)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_mail_template(name, language):
+    return get_template(name)
+
+
+def clear_template_cache():
+    _get_subject_template.cache_clear()
+    _get_mail_template.cache_clear()
+
+
+@receiver(setting_changed)
+def _clear_templates(*, setting, **kwargs):
+    if setting == 'TEMPLATES' or setting.startswith('EMAIL_') or setting.startswith('LANGUAGE'):
+        clear_template_cache()
+
+
+@receiver(file_changed)
+def _clear_templates_on_file_change(*, file_path, **kwargs):
+    if file_path.suffix != '.py':
+        clear_template_cache()
+
+
+def get_link_prefixes(kind, urlconf=None):
+    """
+    Return the url prefixes of the views decorated for the given kind.
+
+    The lookup is cached per resolver, language and kind, so the whole URLconf is scanned only once.
+
+    Args:
+        kind (str): either 'MAIL' or 'PASSWORD'
+        urlconf (str): optional URLconf override, defaults to the one of the current thread
+
+    Returns:
+        (tuple): the prefixes found, the token has to be appended to them
+    """
+    if urlconf is None:
+        urlconf = get_urlconf()
+    return _resolve_link_prefixes(get_resolver(urlconf), get_language(), kind)
+
+
+@functools.lru_cache(maxsize=32)
+def _resolve_link_prefixes(resolver, language, kind):
+    def has_decorator(k):
+        if callable(k):
+            return k.__dict__.get(f'django_email_verification_{kind.lower()}_view_id', False)
+        return False
+
+    d = [v[0][0] for k, v in resolver.reverse_dict.items() if has_decorator(k)]
+    return tuple(a[0][:a[0].index('%')] for a in d if len(a[1]))
+
+
+link_prefix_cache_info = _resolve_link_prefixes.cache_info
+
+
+@receiver(setting_changed)
+def _clear_link_prefixes(*, setting, **kwargs):
+    if setting in ('ROOT_URLCONF', 'LANGUAGES', 'LANGUAGE_CODE'):
+        _resolve_link_prefixes.cache_clear()
+    if setting in ('EMAIL_PAGE_DOMAIN', 'EMAIL_PAGE_SCHEME', 'ROOT_URLCONF'):
+        _check_link_prefix.cache_clear()
 
 
 def verify_email(token):
-    valid, user = default_token_generator.check_token(token, kind='MAIL')
-    if valid:
-        callback = _get_validated_field('EMAIL_MAIL_CALLBACK', default_type=Callable)
-        if hasattr(user, callback.__name__):
-            getattr(user, callback.__name__)()
-        else:
-            callback(user)
-        user.save()
-        return valid, user
-    return False, None
+    return _verify_inner(token, 'MAIL')
 
 
 def verify_password(token, password):
-    valid, user = default_token_generator.check_token(token, kind='PASSWORD')
-    if valid:
-        callback = _get_validated_field('EMAIL_PASSWORD_CALLBACK', default_type=Callable)
-        if hasattr(user, callback.__name__):
-            getattr(user, callback.__name__)(password)
+    return _verify_inner(token, 'PASSWORD', password)
+
+
+async def averify_email(token):
+    return await _averify_inner(token, 'MAIL')
+
+
+async def averify_password(token, password):
+    return await _averify_inner(token, 'PASSWORD', password)
+
+
+def _verify_inner(token, kind, *args):
+    valid, user = default_token_generator.consume_token(token, kind=kind)
+    if not valid:
+        _verify_failed(kind)
+        return False, None
+    try:
+        fields = _run_callback(kind, user, *args)
+        user.save(**_get_update_kwargs(fields))
+    except Exception:
+        # the token has not been used if the user was not saved
+        default_token_generator.release_token(token, kind=kind)
+        raise
+    _verified(kind, user)
+    return True, user
+
+
+async def _averify_inner(token, kind, *args):
+    valid, user = await default_token_generator.aconsume_token(token, kind=kind)
+    if not valid:
+        _verify_failed(kind)
+        return False, None
+    try:
+        fields = await _arun_callback(kind, user, *args)
+        await user.asave(**_get_update_kwargs(fields))
+    except Exception:
+        await default_token_generator.arelease_token(token, kind=kind)
+        raise
+    _verified(kind, user)
+    return True, user
+
+
+def verify_email_bulk(tokens, batch_size=None):
+    """
+    Verify many email tokens at once: they are all decoded first, the users are fetched with a single query and the
+    changes made by the callback are saved with bulk_update().
+
+    Args:
+        tokens (Iterable[str]): the tokens
+        batch_size (int): number of users saved by each UPDATE, EMAIL_BULK_CHUNK_SIZE by default
+
+    Returns:
+        (list[BulkVerifyResult]): a result for each token, in the same order
+    """
+    tokens = list(tokens)
+    checked = default_token_generator.consume_tokens(tokens, kind='MAIL')
+
+    try:
+        # the users sharing the same changed fields are saved together, each user once
+        updates = {}
+        for valid, user in checked:
+            if valid:
+                fields = _run_callback('MAIL', user)
+                if not isinstance(fields, (list, tuple, set, frozenset)):
+                    deferred = user.get_deferred_fields()
+                    fields = [f.attname for f in user._meta.concrete_fields
+                              if not f.primary_key and f.attname not in deferred]
+                updates.setdefault(tuple(sorted(fields)), {})[user.pk] = user
+
+        model = get_user_model()
+        for fields, users in updates.items():
+            if fields:
+                model.objects.bulk_update(users.values(), fields,
+                                          batch_size=batch_size or get_config().bulk_chunk_size)
+    except Exception:
+        default_token_generator.release_tokens([t for t, (valid, _) in zip(tokens, checked) if valid], kind='MAIL')
+        raise
+
+    results = []
+    for token, (valid, user) in zip(tokens, checked):
+        if valid:
+            _verified('MAIL', user)
         else:
-            callback(user, password)
-        user.save()
-        return valid, user
-    return False, None
+            _verify_failed('MAIL')
+        results.append(BulkVerifyResult(token, valid, user))
+    return results
+
+
+def _verified(kind, user):
+    get_metrics().increment('verified', kind)
+    token_verified.send(sender=type(user), user=user, kind=kind)
+
+
+def _verify_failed(kind):
+    get_metrics().increment('verify_failed', kind)
+    verification_failed.send(sender=None, user=None, kind=kind, stage='verify', error=None)
+
+
+def _run_callback(kind, user, *args):
+    callback = get_config().kinds[kind].callback
+    if callback is None:
+        raise NotAllFieldCompiled(f'Field EMAIL_{kind}_CALLBACK missing or invalid')
+    if hasattr(user, callback.__name__):
+        return getattr(user, callback.__name__)(*args)
+    return callback(user, *args)
+
+
+def _get_update_kwargs(fields):
+    # a callback can return the names of the fields it changed, so that only those are saved
+    if isinstance(fields, (list, tuple, set, frozenset)):
+        return {'update_fields': fields}
+    return {}
+
+
+async def _arun_callback(kind, user, *args):
+    result = _run_callback(kind, user, *args)
+    if asyncio.iscoroutine(result):
+        result = await result
+    return result
 
 
-@deprecation.deprecated(deprecated_in='0.3.0', details='use either verify_email() or verify_password()')
+def _deprecated(details):
+    # the deprecation package is imported only when a deprecated function is called
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            import deprecation
+            return deprecation.deprecated(deprecated_in='0.3.0', details=details)(func)(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@_deprecated('use either verify_email() or verify_password()')
 def verify_token(token):  # pragma: no cover
     return verify_email(token)
 
 
 def verify_email_view(func):
     func.django_email_verification_mail_view_id = True
-
-    @functools.wraps(func)
-    def verify_function_wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
-
-    return verify_function_wrapper
+    return _wrap_view(func)
 
 
 def verify_password_view(func):
     func.django_email_verification_password_view_id = True
+    return _wrap_view(func)
 
-    @functools.wraps(func)
-    def verify_function_wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
+
+def _wrap_view(func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def verify_function_wrapper(*args, **kwargs):
+            return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def verify_function_wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
 
     return verify_function_wrapper
 
 
-@deprecation.deprecated(deprecated_in='0.3.0', details='use either verify_email_view() or verify_password_view()')
+@_deprecated('use either verify_email_view() or verify_password_view()')
 def verify_view(func):  # pragma: no cover
     func.django_email_verification_mail_view_id = True
 
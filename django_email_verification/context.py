@@ -0,0 +1,63 @@
+import threading
+
+_MISSING = object()
+
+
+class _LazyValue:
+    # the templates call the callables they find in the context, and only when the variable is used, so the value is
+    # computed while rendering, inside the worker, and at most once
+    __slots__ = ('func', 'value', 'lock')
+
+    def __init__(self, func):
+        self.func = func
+        self.value = _MISSING
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        if self.value is _MISSING:
+            with self.lock:
+                if self.value is _MISSING:
+                    self.value = self.func()
+        return self.value
+
+
+class per_user:
+    """
+    A context value computed from the user receiving the email, func(user), evaluated only if a template uses it.
+    """
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+
+class shared(_LazyValue):
+    """
+    A context value computed once, func(), the first time a template uses it, and then shared by all the emails sent
+    with the same context (for example all the users of a bulk send).
+    """
+    __slots__ = ()
+
+
+def build_context(context, user):
+    """
+    Build the context of a single email. The context passed to the send functions is never modified: each email gets
+    a new dict, holding the same values, where the per_user values are replaced by their lazy evaluation.
+
+    Args:
+        context (dict | Callable): the context, or a function returning it given the user
+        user (Model): the user receiving the email
+
+    Returns:
+        (dict): the context of the email
+    """
+    if context is None:
+        return {}
+    if callable(context):
+        context = context(user)
+    return {key: _LazyValue(_bind(value.func, user)) if isinstance(value, per_user) else value
+            for key, value in context.items()}
+
+
+def _bind(func, user):
+    return lambda: func(user)
@@ -11,3 +11,38 @@ class EmailTemplateNotFound(Exception):
 class NotAllFieldCompiled(Exception):
     """Compile all the fields in the settings"""
     pass
+
+
+class VerifyViewNotFound(Exception):
+    """No verify view, or more than one, found in the urls"""
+    pass
+
+
+class SendQueueFull(Exception):
+    """The send queue is full"""
+    pass
+
+
+class SendError(Exception):
+    """The email could not be sent, the original exception is the __cause__"""
+    pass
+
+
+class TransientSendError(SendError):
+    """The email could not be sent for now (a timeout, a dropped connection, a 4xx SMTP reply), it can be retried"""
+    pass
+
+
+class PermanentSendError(SendError):
+    """The email has been refused (a 5xx SMTP reply), retrying would fail again"""
+    pass
+
+
+class SendConfigurationError(SendError):
+    """The email cannot be sent until the settings are fixed (templates, urls, credentials)"""
+    pass
+
+
+class CircuitOpen(TransientSendError):
+    """The email backend kept failing, the emails are not sent until it has had time to recover"""
+    pass
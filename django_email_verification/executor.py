@@ -0,0 +1,285 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+from queue import Empty, Full, Queue
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .conf import QUEUE_POLICIES, get_config
+from .errors import SendQueueFull
+
+logger = logging.getLogger('django_email_verification')
+DJANGO_EMAIL_VERIFICATION_QUEUE_FULL = 'WARNING: the send queue is full'
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 1000
+# seconds a worker waits for a job, once the executor is shut down, before stopping
+SHUTDOWN_POLL = 0.1
+
+
+class Retry(Exception):
+    """
+    Raised by a job to be run again, with the given arguments, after delay seconds. The worker is free in the
+    meantime. If the executor is shut down before, give_up() is called instead.
+    """
+
+    def __init__(self, delay, args, give_up=None):
+        super().__init__(delay)
+        self.delay = delay
+        self.job_args = args
+        self.give_up = give_up
+
+
+class SendExecutor:
+    """
+    Fixed size pool of worker threads consuming a bounded queue of send jobs.
+
+    When the queue is full the behaviour depends on the policy:
+        - 'block': the caller waits until there is room in the queue
+        - 'drop': the job is discarded and a warning is logged
+        - 'raise': SendQueueFull is raised to the caller
+
+    A job raising Retry is submitted again after the delay by a timer thread.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, policy='block'):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy {policy}, expected one of {QUEUE_POLICIES}')
+        self.workers = workers
+        self.policy = policy
+        self._queue = Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._busy = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._retried = 0
+        self._timers = []
+        self._timer_thread = None
+        self._timer_cond = threading.Condition()
+        self._sequence = itertools.count()
+
+    def submit(self, fn, *args):
+        """
+        Enqueue a job, starting the workers on first use.
+
+        Returns:
+            (bool): False if the job has been dropped
+        """
+        if self._shutdown:
+            raise RuntimeError('The send executor has been shut down')
+        self._start()
+        try:
+            if self.policy == 'block':
+                self._queue.put((fn, args))
+            else:
+                self._queue.put_nowait((fn, args))
+        except Full:
+            if self.policy == 'raise':
+                raise SendQueueFull(f'The send queue is full ({self._queue.maxsize} jobs)')
+            with self._lock:
+                self._dropped += 1
+            logger.warning(f'{DJANGO_EMAIL_VERIFICATION_QUEUE_FULL} - job dropped')
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop accepting jobs and, if wait is True, drain the queue before returning.
+        The jobs waiting for a retry are given up.
+        """
+        with self._timer_cond:
+            self._shutdown = True
+            timers, self._timers = self._timers, []
+            self._timer_cond.notify()
+        for *_, retry in timers:
+            self._give_up(retry)
+        for _ in self._threads:
+            # with a full queue the workers are busy, they stop once they find it empty
+            try:
+                self._queue.put_nowait((None, None))
+            except Full:
+                break
+        if wait:
+            # a single deadline for all the workers
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            for t in self._threads:
+                t.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def stats(self):
+        """
+        Returns:
+            (dict): queue depth, worker utilisation and job counters
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'alive': sum(t.is_alive() for t in self._threads),
+                'busy': self._busy,
+                'utilisation': self._busy / self.workers,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self._queue.maxsize,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'retried': self._retried,
+                'scheduled': len(self._timers),
+            }
+
+    def _start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, name=f'django_email_verification_{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            try:
+                fn, args = self._queue.get(timeout=SHUTDOWN_POLL if self._shutdown else None)
+            except Empty:
+                break
+            if fn is None:
+                break
+            with self._lock:
+                self._busy += 1
+            try:
+                fn(*args)
+                with self._lock:
+                    self._completed += 1
+            except Retry as retry:
+                with self._lock:
+                    self._retried += 1
+                self._schedule(fn, retry)
+            except Exception as e:
+                with self._lock:
+                    self._failed += 1
+                logger.error(repr(e))
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                close_old_connections()
+
+    def _schedule(self, fn, retry):
+        with self._timer_cond:
+            if not self._shutdown:
+                heapq.heappush(self._timers, (time.monotonic() + retry.delay, next(self._sequence), fn, retry))
+                if self._timer_thread is None:
+                    self._timer_thread = threading.Thread(target=self._run_timers,
+                                                          name='django_email_verification_timers', daemon=True)
+                    self._timer_thread.start()
+                self._timer_cond.notify()
+                return
+        self._give_up(retry)
+
+    def _run_timers(self):
+        while True:
+            with self._timer_cond:
+                while not self._shutdown and (not self._timers or self._timers[0][0] > time.monotonic()):
+                    self._timer_cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                if self._shutdown:
+                    return
+                _, _, fn, retry = heapq.heappop(self._timers)
+            try:
+                submitted = self.submit(fn, *retry.job_args)
+            except (SendQueueFull, RuntimeError):
+                submitted = False
+            if not submitted:
+                self._give_up(retry)
+
+    def _give_up(self, retry):
+        with self._lock:
+            self._failed += 1
+        if retry.give_up is not None:
+            try:
+                retry.give_up()
+            except Exception as e:
+                logger.error(repr(e))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_previous_sigterm = None
+_sigterm_installed = False
+
+
+def get_executor():
+    """
+    Return the module level executor, creating it from the settings on first use.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = get_config()
+                _executor = SendExecutor(config.send_workers, config.send_queue_size, config.send_queue_policy)
+                if config.send_drain_on_sigterm:
+                    _install_sigterm_handler()
+    return _executor
+
+
+def shutdown_executor(wait=True, timeout=None):
+    """
+    Drain the pending emails and stop the workers, a new executor is created on the next send.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait, timeout=timeout)
+
+
+def executor_stats():
+    """
+    Returns:
+        (dict): the stats of the module level executor, see SendExecutor.stats()
+    """
+    return get_executor().stats()
+
+
+def _handle_sigterm(signum, frame):  # pragma: no cover
+    shutdown_executor(wait=True, timeout=get_config().send_drain_timeout)
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)
+    elif _previous_sigterm != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+def _install_sigterm_handler():
+    global _previous_sigterm, _sigterm_installed
+    if _sigterm_installed or threading.current_thread() is not threading.main_thread():
+        return
+    _previous_sigterm = signal.signal(signal.SIGTERM, _handle_sigterm)
+    _sigterm_installed = True
+
+
+def _shutdown_at_exit():
+    # the workers are daemon threads, so a relay that never answers cannot hold the exit longer than the timeout
+    shutdown_executor(wait=True, timeout=get_config().send_drain_timeout)
+
+
+atexit.register(_shutdown_at_exit)
+
+
+@receiver(setting_changed)
+def _reset_executor(*, setting, **kwargs):
+    if setting in ('EMAIL_SEND_WORKERS', 'EMAIL_SEND_QUEUE_SIZE', 'EMAIL_SEND_QUEUE_POLICY'):
+        shutdown_executor()
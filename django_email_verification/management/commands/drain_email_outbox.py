@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send the verification emails waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='number of emails locked and sent at once')
+        parser.add_argument('--max-attempts', type=int, help='number of attempts before an email is marked as failed')
+        parser.add_argument('--backoff', type=int, help='base delay in seconds before a failed email is retried')
+        parser.add_argument('--loop', action='store_true', help='keep polling the outbox instead of exiting')
+        parser.add_argument('--interval', type=float, default=5, help='seconds between polls when the outbox is empty')
+
+    def handle(self, *args, **options):
+        total_sent, total_failed = 0, 0
+        while True:
+            sent, failed = drain_outbox(options['batch_size'], options['max_attempts'], options['backoff'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f'{sent} emails sent, {failed} failed')
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Outbox drained: {total_sent} emails sent, {total_failed} failed'))
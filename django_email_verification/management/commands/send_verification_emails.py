@@ -0,0 +1,108 @@
+import json
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from ...confirm import send_inner_bulk
+from ...conf import KINDS
+
+
+class Command(BaseCommand):
+    help = 'Send the verification emails to all the users matching the filters, in pk order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=KINDS, default='MAIL', help='kind of email to send')
+        parser.add_argument('--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+                            help='queryset filter, for example is_active=false, can be repeated')
+        parser.add_argument('--exclude', action='append', default=[], metavar='LOOKUP=VALUE',
+                            help='queryset exclusion, can be repeated')
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of users fetched by each query')
+        parser.add_argument('--chunk-size', type=int, help='number of messages passed at once to the email backend')
+        parser.add_argument('--shard', metavar='I/N',
+                            help='send only to the I-th of N equal pk ranges (starting from 0), to split the work '
+                                 'across processes or nodes')
+        parser.add_argument('--checkpoint', metavar='FILE',
+                            help='file where the progress is saved after each batch, an interrupted run started '
+                                 'again with the same file resumes from the last user sent')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.filter(**_parse_lookups(options['filter']))
+        users = users.exclude(**_parse_lookups(options['exclude'])).order_by('pk')
+        if options['shard']:
+            users = _get_shard(users, options['shard'])
+
+        checkpoint = options['checkpoint']
+        progress = _load_checkpoint(checkpoint)
+        if progress['last_pk'] is not None:
+            self.stdout.write(f'Resuming after pk {progress["last_pk"]}, {progress["sent"]} emails already sent')
+
+        start = time.monotonic()
+        sent, failed = 0, 0
+        while True:
+            # keyset pagination: each batch starts after the last pk, so the queries stay fast on any offset
+            page = users if progress['last_pk'] is None else users.filter(pk__gt=progress['last_pk'])
+            batch = list(page[:options['batch_size']].iterator(chunk_size=options['batch_size']))
+            if not batch:
+                break
+            results = send_inner_bulk(batch, None, options['kind'], chunk_size=options['chunk_size'])
+            batch_failed = sum(result.error is not None for result in results)
+            sent += len(results) - batch_failed
+            failed += batch_failed
+            progress.update(last_pk=batch[-1].pk, sent=progress['sent'] + len(results) - batch_failed,
+                            failed=progress['failed'] + batch_failed)
+            _save_checkpoint(checkpoint, progress)
+            rate = (sent + failed) / max(time.monotonic() - start, 1e-6)
+            self.stdout.write(f'{sent} emails sent, {failed} failed, {rate:.1f} emails/s, last pk {batch[-1].pk}')
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {sent} emails sent, {failed} failed'))
+
+
+def _parse_lookups(lookups):
+    # the values are parsed as JSON when possible, so that true, false, null and the numbers keep their type
+    parsed = {}
+    for lookup in lookups:
+        key, sep, value = lookup.partition('=')
+        if not sep or not key:
+            raise CommandError(f'Invalid lookup {lookup!r}, expected LOOKUP=VALUE')
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+    return parsed
+
+
+def _get_shard(users, shard):
+    try:
+        index, count = map(int, shard.split('/'))
+    except ValueError:
+        raise CommandError(f'Invalid shard {shard!r}, expected I/N')
+    if not 0 <= index < count:
+        raise CommandError(f'Invalid shard {shard!r}, I must be between 0 and N - 1')
+
+    bounds = users.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return users
+    if not isinstance(bounds['low'], int):
+        raise CommandError('--shard requires an integer primary key')
+    size = (bounds['high'] - bounds['low']) // count + 1
+    low = bounds['low'] + index * size
+    return users.filter(pk__gte=low, pk__lt=low + size)
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return {'last_pk': None, 'sent': 0, 'failed': 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path, progress):
+    if path is None:
+        return
+    # written to a temporary file and renamed, so that a crash never leaves a truncated checkpoint
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(progress, f, default=str)
+    os.replace(f'{path}.tmp', path)
@@ -0,0 +1,118 @@
+import functools
+import time
+from contextlib import nullcontext
+
+from django.utils.module_loading import import_string
+
+from .conf import get_config
+
+METRIC_PREFIX = 'django_email_verification'
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_NULL_TIMER = nullcontext()
+
+
+class MetricsHook:
+    """
+    Receives the duration of each stage of the send and verify pipelines and the count of the outcomes.
+
+    The stages are 'save', 'resolve', 'render', 'send' and 'total' when sending an email, 'decode' and 'lookup' when
+    checking a token. The events are 'sent', 'send_failed', 'verified' and 'verify_failed'.
+
+    This base class does nothing, and it is used when EMAIL_METRICS_HOOK is not set: subclasses implement
+    timing() and increment(), timer() is built on timing().
+    """
+    enabled = False
+
+    def timer(self, stage, kind):
+        """
+        Returns:
+            (ContextManager): a context manager reporting the time spent inside it as the given stage
+        """
+        return _Timer(self, stage, kind) if self.enabled else _NULL_TIMER
+
+    def timing(self, stage, kind, seconds):
+        pass
+
+    def increment(self, event, kind):
+        pass
+
+
+class _Timer:
+    __slots__ = ('hook', 'stage', 'kind', 'start')
+
+    def __init__(self, hook, stage, kind):
+        self.hook = hook
+        self.stage = stage
+        self.kind = kind
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.hook.timing(self.stage, self.kind, time.perf_counter() - self.start)
+
+
+class StatsdHook(MetricsHook):
+    """
+    Send the metrics through a StatsD client (for example statsd.StatsClient), as
+    '<prefix>.<stage>.<kind>' timings in milliseconds and '<prefix>.<event>.<kind>' counters.
+    """
+    enabled = True
+
+    def __init__(self, client=None, prefix=METRIC_PREFIX):
+        if client is None:
+            from statsd import StatsClient
+            client = StatsClient()
+        self.client = client
+        self.prefix = prefix
+
+    def timing(self, stage, kind, seconds):
+        self.client.timing(f'{self.prefix}.{stage}.{kind.lower()}', seconds * 1000)
+
+    def increment(self, event, kind):
+        self.client.incr(f'{self.prefix}.{event}.{kind.lower()}')
+
+
+class PrometheusHook(MetricsHook):
+    """
+    Record the metrics with prometheus_client, in the '<prefix>_stage_seconds' histogram and the
+    '<prefix>_events_total' counter, both labelled by stage or event and kind.
+    """
+    enabled = True
+
+    def __init__(self, registry=None, prefix=METRIC_PREFIX, buckets=STAGE_BUCKETS):
+        from prometheus_client import REGISTRY, Counter, Histogram
+        registry = registry if registry is not None else REGISTRY
+        self.stages = Histogram(f'{prefix}_stage_seconds', 'Duration of the stages of django-email-verification',
+                                ('stage', 'kind'), registry=registry, buckets=buckets)
+        self.events = Counter(f'{prefix}_events', 'Outcomes of the sends and verifications',
+                              ('event', 'kind'), registry=registry)
+
+    def timing(self, stage, kind, seconds):
+        self.stages.labels(stage, kind).observe(seconds)
+
+    def increment(self, event, kind):
+        self.events.labels(event, kind).inc()
+
+
+_noop = MetricsHook()
+
+
+def get_metrics():
+    """
+    Return the hook set in EMAIL_METRICS_HOOK, the dotted path of a MetricsHook instance or of a callable returning
+    one (for example 'django_email_verification.metrics.PrometheusHook').
+
+    Returns:
+        (MetricsHook): the hook, a no-op one if the setting is missing
+    """
+    path = get_config().metrics_hook
+    return _noop if path is None else _load_hook(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_hook(path):
+    # created once per path, so the metrics are registered only once
+    hook = import_string(path)
+    return hook if isinstance(hook, MetricsHook) else hook()
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-18 00:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_pk', models.CharField(max_length=255)),
+                ('kind', models.CharField(max_length=16)),
+                ('expiry', models.BigIntegerField()),
+                ('context', models.JSONField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['failed', 'next_attempt'], name='django_emai_failed_464c19_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import models
+from django.utils import timezone
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be sent by the drain_email_outbox command, used when EMAIL_OUTBOX is True.
+    """
+    user_pk = models.CharField(max_length=255)
+    kind = models.CharField(max_length=16)
+    expiry = models.BigIntegerField()
+    context = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    failed = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['failed', 'next_attempt'])]
+
+    def __str__(self):
+        return f'{self.kind} email for user {self.user_pk}'
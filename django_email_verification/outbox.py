@@ -0,0 +1,108 @@
+import logging
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from .conf import get_config
+from .confirm import _build_message, _get_link_prefix, _get_send_args, _send_failed, _sent
+from .errors import InvalidUserModel, PermanentSendError, VerifyViewNotFound
+from .metrics import get_metrics
+from .models import OutboxEmail
+from .retry import classify_error
+from .transport import get_transport
+
+logger = logging.getLogger('django_email_verification')
+
+
+def drain_outbox(batch_size=None, max_attempts=None, backoff=None):
+    """
+    Send one batch of the pending emails of the outbox.
+
+    The rows are locked with select_for_update(skip_locked=True), so many processes can drain the outbox at once.
+    Each email is sent and its row deleted in its own transaction, so a database error never rolls back the rows of
+    the emails already sent. An email whose token expired while waiting in the outbox is marked as failed.
+    A failed email is retried after backoff * 2 ** (attempts - 1) seconds, until max_attempts is reached.
+
+    Args:
+        batch_size (int): maximum number of emails sent
+        max_attempts (int): number of attempts before an email is marked as failed
+        backoff (int): base delay, in seconds, before a failed email is retried
+
+    Returns:
+        (tuple): tuple containing:
+            sent (int): the number of emails sent
+            failed (int): the number of emails that failed
+    """
+    config = get_config()
+    batch_size = batch_size or config.outbox_batch_size
+    max_attempts = max_attempts or config.outbox_max_attempts
+    backoff = backoff if backoff is not None else config.outbox_backoff
+    sent, failed = 0, 0
+
+    now = timezone.now()
+    candidates = list(OutboxEmail.objects.filter(failed=False, next_attempt__lte=now).order_by('next_attempt')
+                      .values_list('pk', 'user_pk')[:batch_size])
+    if not candidates:
+        return sent, failed
+    users = {str(u.pk): u for u in get_user_model().objects.filter(pk__in=[user_pk for _, user_pk in candidates])}
+
+    metrics = get_metrics()
+    with get_transport() as transport:
+        for pk, user_pk in candidates:
+            # each email has its own transaction, so a database error cannot undo the rows of the emails already sent
+            with transaction.atomic():
+                row = OutboxEmail.objects.select_for_update(skip_locked=True) \
+                    .filter(pk=pk, failed=False, next_attempt__lte=now).first()
+                if row is None:
+                    # taken by another process
+                    continue
+                user = users.get(user_pk)
+                sent_args, error = None, None
+                try:
+                    sent_args = _send_row(row, user, transport, metrics, now)
+                except Exception as e:
+                    error = e
+                    logger.error(repr(e))
+                    failed += 1
+                    row.attempts += 1
+                    row.last_error = repr(e)
+                    # a refused email would be refused again
+                    row.failed = row.attempts >= max_attempts or isinstance(classify_error(e), PermanentSendError)
+                    row.next_attempt = now + timedelta(seconds=backoff * 2 ** (row.attempts - 1))
+                    row.save(update_fields=['attempts', 'last_error', 'failed', 'next_attempt'])
+                else:
+                    sent += 1
+                    row.delete()
+
+            # reported only once the row is committed, the failure only once the email is given up
+            if error is None:
+                _sent(*sent_args)
+            elif row.failed:
+                _send_failed(user, row.kind, error)
+            else:
+                metrics.increment('send_retry', row.kind)
+
+    return sent, failed
+
+
+def _send_row(row, user, transport, metrics, now):
+    if user is None:
+        raise InvalidUserModel(f'User {row.user_pk} not found')
+    if row.expiry <= now.timestamp():
+        # the link would be already expired
+        raise PermanentSendError(f'The token expired before the email was sent ({row.expiry})')
+    with metrics.timer('total', row.kind):
+        user, kind, token, expiry, sender, domain, subject, mail_plain, mail_html, debug, context, \
+            urlconf = _get_send_args(user, row.expiry, row.kind, row.context)
+        with metrics.timer('resolve', kind):
+            link_prefix = _get_link_prefix(kind, domain, urlconf)
+        if link_prefix is None:
+            raise VerifyViewNotFound(f'No single verify view found for {kind}')
+        with metrics.timer('render', kind):
+            msg = _build_message(user, token, expiry, sender, link_prefix, subject, mail_plain, mail_html, debug,
+                                 context)
+        with metrics.timer('send', kind):
+            transport.send_messages([msg])
+    return user, kind, token, expiry
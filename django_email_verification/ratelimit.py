@@ -0,0 +1,157 @@
+import functools
+import hashlib
+import time
+
+from django.core.cache import caches
+
+from .conf import get_config
+
+RATE_LIMIT_SCOPES = ('email', 'user', 'ip')
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+REJECTED_DUPLICATE = 'duplicate'
+REJECTED_EMAIL = 'rate_limit:email'
+REJECTED_USER = 'rate_limit:user'
+REJECTED_IP = 'rate_limit:ip'
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(rate):
+    """
+    Args:
+        rate (str | tuple): a rate like '5/h' or '10/15m', or a (requests, seconds) tuple
+
+    Returns:
+        (tuple): the number of requests allowed and the length of the window in seconds
+    """
+    if isinstance(rate, tuple):
+        requests, period = rate
+        return int(requests), int(period)
+    requests, period = rate.split('/')
+    multiplier = period[:-1] or 1
+    return int(requests), int(multiplier) * RATE_PERIODS[period[-1]]
+
+
+def rate_limit_enabled():
+    """
+    Returns:
+        (bool): True if EMAIL_RATE_LIMITS or EMAIL_DEDUP_WINDOW are set
+    """
+    config = get_config()
+    return bool(config.rate_limits or config.dedup_window)
+
+
+def check_send(user, kind, request=None):
+    """
+    Check the dedup window and the rate limits configured in EMAIL_DEDUP_WINDOW and EMAIL_RATE_LIMITS,
+    counting the send if it is allowed. The limits are shared by both kinds of email, the dedup is per kind.
+
+    The dedup window is claimed with cache.add() and the send is counted before being compared with the limits, so
+    that concurrent sends cannot all pass the checks: a rejected send gives back the counts it has taken.
+
+    Args:
+        user (Model): the user the email is sent to
+        kind (str): 'MAIL' or 'PASSWORD'
+        request (HttpRequest): optional request, used to limit by client IP
+
+    Returns:
+        (str): the reason the send has been rejected, None if it is allowed
+    """
+    if not rate_limit_enabled():
+        return None
+    config = get_config()
+    cache = caches[config.rate_limit_cache]
+
+    deduped = config.dedup_window and user.pk is not None
+    if deduped and not cache.add(_dedup_key(user, kind), (None, None), config.dedup_window):
+        return REJECTED_DUPLICATE
+
+    values = {
+        'email': (getattr(user, 'email', None) or '').strip().lower(),
+        'user': user.pk,
+        'ip': request.META.get('REMOTE_ADDR') if request is not None else None,
+    }
+    hits = []
+    for scope in RATE_LIMIT_SCOPES:
+        rate = (config.rate_limits or {}).get(scope)
+        if rate is None or values[scope] in (None, ''):
+            continue
+        requests, period = parse_rate(rate)
+        counter = _hit(cache, f'django_email_verification:rate:{scope}:{_digest(values[scope])}', requests, period)
+        if counter is None:
+            for counter in hits:
+                _unhit(cache, counter)
+            if deduped:
+                cache.delete(_dedup_key(user, kind))
+            return f'rate_limit:{scope}'
+        hits.append(counter)
+    return None
+
+
+def record_send(user, kind, token=None, expiry=None):
+    """
+    Store the token sent to the user, further sends are rejected as duplicates until EMAIL_DEDUP_WINDOW elapses.
+    """
+    config = get_config()
+    if config.dedup_window and user.pk is not None:
+        caches[config.rate_limit_cache].set(_dedup_key(user, kind), (token, expiry), config.dedup_window)
+
+
+def forget_send(user, kind):
+    """
+    Remove the token stored by record_send(), when the email could not be delivered, so that it can be sent again.
+    """
+    config = get_config()
+    if config.dedup_window and getattr(user, 'pk', None) is not None:
+        caches[config.rate_limit_cache].delete(_dedup_key(user, kind))
+
+
+def get_outstanding(user, kind):
+    """
+    Returns:
+        (tuple): the token and expiry of the email sent within EMAIL_DEDUP_WINDOW, None if there is none
+    """
+    config = get_config()
+    if not config.dedup_window or user.pk is None:
+        return None
+    return caches[config.rate_limit_cache].get(_dedup_key(user, kind))
+
+
+def _dedup_key(user, kind):
+    return f'django_email_verification:dedup:{kind}:{_digest(user.pk)}'
+
+
+def _digest(value):
+    # keeps the keys short and free of characters some backends reject
+    return hashlib.sha256(str(value).encode()).hexdigest()[:32]
+
+
+def _window(period, now):
+    return int(now // period)
+
+
+def _hit(cache, key, requests, period):
+    # sliding window: the previous window is weighted by the part of it still inside the sliding window
+    now = time.time()
+    window = _window(period, now)
+    current = f'{key}:{window}'
+    cache.add(current, 0, period * 2)
+    try:
+        count = cache.incr(current)
+    except ValueError:
+        # expired between add() and incr()
+        cache.set(current, 1, period * 2)
+        count = 1
+    elapsed = (now % period) / period
+    if cache.get(f'{key}:{window - 1}', 0) * (1 - elapsed) + count > requests:
+        _unhit(cache, current)
+        return None
+    return current
+
+
+def _unhit(cache, counter):
+    try:
+        cache.decr(counter)
+    except ValueError:
+        # already expired
+        pass
@@ -0,0 +1,155 @@
+import random
+import smtplib
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+
+from .conf import get_config
+from .errors import CircuitOpen, EmailTemplateNotFound, InvalidUserModel, NotAllFieldCompiled, \
+    PermanentSendError, SendConfigurationError, SendError, TransientSendError, VerifyViewNotFound
+
+CONFIGURATION_ERRORS = (NotAllFieldCompiled, VerifyViewNotFound, EmailTemplateNotFound, InvalidUserModel,
+                        ImproperlyConfigured, TemplateDoesNotExist, TemplateSyntaxError,
+                        smtplib.SMTPAuthenticationError, smtplib.SMTPNotSupportedError)
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError, OSError)
+
+
+def classify_error(error):
+    """
+    Wrap an exception raised while sending in the SendError subclass telling whether it can be retried.
+
+    Args:
+        error (Exception): the exception
+
+    Returns:
+        (SendError): a TransientSendError, a PermanentSendError or a SendConfigurationError, with the exception as
+            __cause__
+    """
+    if isinstance(error, SendError):
+        return error
+    if isinstance(error, CONFIGURATION_ERRORS):
+        cls = SendConfigurationError
+    elif isinstance(error, smtplib.SMTPRecipientsRefused):
+        # transient only if every recipient got a 4xx reply
+        codes = [code for code, _ in error.recipients.values()]
+        cls = TransientSendError if codes and all(400 <= code < 500 for code in codes) else PermanentSendError
+    elif isinstance(error, smtplib.SMTPResponseException):
+        cls = TransientSendError if 400 <= error.smtp_code < 500 else PermanentSendError
+    elif isinstance(error, TRANSIENT_ERRORS):
+        cls = TransientSendError
+    else:
+        cls = PermanentSendError
+    classified = cls(repr(error))
+    classified.__cause__ = error
+    return classified
+
+
+def backend_replied(error):
+    """
+    Returns:
+        (bool): True if the error is a reply of the email backend (an SMTP error code, a refused recipient), which
+            means that the backend is working even though the email was not sent
+    """
+    cause = error.__cause__ if isinstance(error, SendError) else error
+    return isinstance(error, PermanentSendError) or \
+        isinstance(cause, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+
+
+def backoff_delay(attempt, base, cap):
+    """
+    Exponential backoff with full jitter: a random delay up to base * 2 ** attempt, capped.
+
+    Returns:
+        (float): the seconds to wait before the attempt + 1 retry
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stop sending when the email backend keeps failing.
+
+    After threshold consecutive failures the circuit opens and allow() returns False for reset_timeout seconds, then
+    a single trial send is allowed (half open): if it succeeds the circuit closes, otherwise it opens again.
+    A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        Returns:
+            (str): 'closed', 'open' or 'half_open'
+        """
+        if self._opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self._opened_at < self.reset_timeout else 'half_open'
+
+    def allow(self):
+        """
+        Returns:
+            (bool): False if the circuit is open, the trial send of a half open circuit is allowed once
+        """
+        if not self.threshold or self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            # half open, the other sends wait for the outcome of this one
+            self._opened_at = time.monotonic()
+            return True
+
+    def success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+
+    def failure(self):
+        if not self.threshold:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+    def check(self):
+        """
+        Raise CircuitOpen if the send is not allowed.
+        """
+        if not self.allow():
+            raise CircuitOpen(f'The email backend failed {self._failures} times in a row, the circuit is open')
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    Return the module level circuit breaker, built from EMAIL_SEND_CIRCUIT_THRESHOLD and EMAIL_SEND_CIRCUIT_RESET.
+    """
+    global _breaker
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                config = get_config()
+                _breaker = CircuitBreaker(config.send_circuit_threshold, config.send_circuit_reset)
+    return _breaker
+
+
+@receiver(setting_changed)
+def _reset_circuit_breaker(*, setting, **kwargs):
+    global _breaker
+    if setting in ('EMAIL_SEND_CIRCUIT_THRESHOLD', 'EMAIL_SEND_CIRCUIT_RESET'):
+        _breaker = None
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent after an email has been handed to the email backend.
+# Arguments: sender (the user model), user, kind, token, expiry
+verification_email_sent = Signal()
+
+# Sent when an email cannot be sent or a token is rejected.
+# Arguments: sender (the user model, or None if the user is unknown), user, kind, stage, error
+# stage is 'send' for the emails, with the exception raised in error, and 'verify' for the tokens, with error None
+verification_failed = Signal()
+
+# Sent after a token has been verified and the callback saved the user.
+# Arguments: sender (the user model), user, kind
+token_verified = Signal()
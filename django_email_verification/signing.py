@@ -0,0 +1,165 @@
+import base64
+import binascii
+import functools
+import hashlib
+import hmac
+import json
+from datetime import datetime
+
+from django.utils.module_loading import import_string
+
+from .conf import get_config
+
+HMAC_DIGESTS = {'HS256': hashlib.sha256, 'HS384': hashlib.sha384, 'HS512': hashlib.sha512}
+
+
+class Signer:
+    """
+    Encodes and signs the payload of the JWT tokens, and checks them. Subclasses implement encode() and decode().
+    """
+
+    def encode(self, payload, keyring, algorithm):
+        """
+        Args:
+            payload (dict): the payload
+            keyring (Keyring): the keys, the token is signed with keyring.key and its id is stored in the kid header
+            algorithm (str): the JWT algorithm
+
+        Returns:
+            (str): the token
+        """
+        raise NotImplementedError
+
+    def decode(self, token, keyring, algorithm):
+        """
+        Args:
+            token (str): the token
+            keyring (Keyring): the keys, the one matching the kid header or, without it, the legacy secrets
+            algorithm (str): the only JWT algorithm accepted
+
+        Returns:
+            (dict): the payload, None if the token is malformed, expired or the signature is wrong
+        """
+        raise NotImplementedError
+
+
+class PyJWTSigner(Signer):
+    """
+    Sign with PyJWT, the implementation used before the signers were introduced.
+    """
+
+    def encode(self, payload, keyring, algorithm):
+        import jwt
+        return jwt.encode(payload, keyring.key, algorithm=algorithm, headers={'kid': keyring.kid.hex()})
+
+    def decode(self, token, keyring, algorithm):
+        import jwt
+        algorithms = [algorithm]
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            if kid is not None:
+                key = keyring.keys.get(bytes.fromhex(kid))
+                return jwt.decode(token, key, algorithms=algorithms) if key is not None else None
+            # tokens created before the keys were derived are signed with the raw secret key
+            for secret in keyring.legacy:
+                try:
+                    return jwt.decode(token, secret, algorithms=algorithms)
+                except jwt.InvalidSignatureError:
+                    continue
+        except jwt.InvalidTokenError:
+            return None
+        return None
+
+
+class HMACSigner(Signer):
+    """
+    Sign the HS256, HS384 and HS512 tokens with hmac directly. The tokens are the same built by PyJWT, but the
+    header of each key is encoded once and the keyed hash is computed once for each key and then copied, instead of
+    being derived again for every token.
+    """
+
+    def encode(self, payload, keyring, algorithm):
+        signing_input = _get_header(algorithm, keyring.kid.hex()) + b'.' + \
+            _b64encode(json.dumps(payload, separators=(',', ':')).encode())
+        return (signing_input + b'.' + _b64encode(_sign(keyring.key, algorithm, signing_input))).decode()
+
+    def decode(self, token, keyring, algorithm):
+        try:
+            signing_input, signature = token.encode('ascii').rsplit(b'.', 1)
+            header, payload = signing_input.split(b'.')
+            signature = _b64decode(signature)
+            kid = _get_kid(header, algorithm)
+            if kid is not None:
+                key = keyring.keys.get(bytes.fromhex(kid))
+                keys = (key,) if key is not None else ()
+            else:
+                keys = tuple(secret.encode() for secret in keyring.legacy)
+            if not any(hmac.compare_digest(signature, _sign(key, algorithm, signing_input)) for key in keys):
+                return None
+            payload = json.loads(_b64decode(payload))
+        except (ValueError, TypeError, binascii.Error):
+            return None
+        return payload if isinstance(payload, dict) and _check_claims(payload) else None
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_header(algorithm, kid):
+    # the same header written by PyJWT
+    return _b64encode(json.dumps({'alg': algorithm, 'kid': kid, 'typ': 'JWT'}, separators=(',', ':')).encode())
+
+
+@functools.lru_cache(maxsize=32)
+def _get_kid(header, algorithm):
+    # the tokens signed with the same key share the header, so it is parsed once
+    header = json.loads(_b64decode(header))
+    if not isinstance(header, dict) or header.get('alg') != algorithm:
+        raise ValueError('Invalid token header')
+    return header.get('kid')
+
+
+@functools.lru_cache(maxsize=32)
+def _get_hmac(key, algorithm):
+    return hmac.new(key, digestmod=HMAC_DIGESTS[algorithm])
+
+
+def _sign(key, algorithm, data):
+    mac = _get_hmac(key, algorithm).copy()
+    mac.update(data)
+    return mac.digest()
+
+
+def _check_claims(payload):
+    # the registered claims checked by PyJWT
+    now = datetime.now().timestamp()
+    for claim in ('exp', 'nbf', 'iat'):
+        if claim in payload and (isinstance(payload[claim], bool) or not isinstance(payload[claim], (int, float))):
+            return False
+    return ('exp' not in payload or payload['exp'] > now) and ('nbf' not in payload or payload['nbf'] <= now)
+
+
+def get_signer():
+    """
+    Return the signer set in EMAIL_TOKEN_SIGNER, the dotted path of a Signer instance or of a callable returning one.
+
+    Returns:
+        (Signer): the signer, an HMACSigner if the setting is missing
+    """
+    path = get_config().token_signer
+    return _hmac_signer if path is None else _load_signer(path)
+
+
+_hmac_signer = HMACSigner()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_signer(path):
+    signer = import_string(path)
+    return signer if isinstance(signer, Signer) else signer()
@@ -1,19 +1,68 @@
+import io
+import json
 import logging
+import os
 import re
+import smtplib
+import subprocess
+import sys
+import threading
 import time
 from datetime import datetime
+from unittest import mock
 
 import jwt
 import pytest
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from django.template import TemplateDoesNotExist
 from django.template.loader import render_to_string
-from django.test import Client
+from django.test import Client, AsyncClient
+from django.utils.translation import get_language
 
-from django_email_verification import send_password, send_email
+from django_email_verification import send_password, send_email, send_email_bulk, send_password_bulk, asend_email, \
+    asend_password, averify_email, verify_email, verify_password, wait, as_completed, verify_email_bulk
 from django_email_verification.confirm import DJANGO_EMAIL_VERIFICATION_MORE_VIEWS_ERROR, \
-    DJANGO_EMAIL_VERIFICATION_MALFORMED_URL, DJANGO_EMAIL_VERIFICATION_URL_ROUTE_ERROR
-from django_email_verification.errors import NotAllFieldCompiled, InvalidUserModel
+    DJANGO_EMAIL_VERIFICATION_MALFORMED_URL, DJANGO_EMAIL_VERIFICATION_URL_ROUTE_ERROR, get_link_prefixes, \
+    link_prefix_cache_info, _get_subject_template, _get_mail_template
+from django_email_verification.conf import get_config, check_settings
+from django_email_verification.context import per_user, shared
+from django_email_verification.signing import HMACSigner, PyJWTSigner
+from django_email_verification.errors import NotAllFieldCompiled, InvalidUserModel, SendQueueFull, CircuitOpen, \
+    PermanentSendError, SendConfigurationError, TransientSendError
+from django_email_verification.executor import SendExecutor, _shutdown_at_exit, executor_stats
+from django_email_verification.metrics import MetricsHook
+from django_email_verification.models import OutboxEmail
+from django_email_verification.outbox import drain_outbox
+from django_email_verification.ratelimit import REJECTED_DUPLICATE, REJECTED_EMAIL, REJECTED_IP, REJECTED_USER, \
+    check_send, get_outstanding
+from django_email_verification.retry import CircuitBreaker, classify_error, get_circuit_breaker
+from django_email_verification.signals import token_verified, verification_email_sent, verification_failed
+from django_email_verification.token_utils import default_token_generator
+from django_email_verification.transport import DjangoTransport, FakeTransport, get_transport
+
+
+class RecordingHook(MetricsHook):
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+
+    def timing(self, stage, kind, seconds):
+        self.events.append(('timing', stage, kind))
+
+    def increment(self, event, kind):
+        self.events.append(('increment', event, kind))
+
+
+recording_hook = RecordingHook()
 
 
 class LogHandler(logging.StreamHandler):
@@ -66,6 +115,17 @@ def check_password_change(test_user, mailoutbox, client):
     assert get_user_model().objects.get(email='test@test.com').check_password(new_password)
 
 
+def resign_token(token, **changes):
+    keyring = default_token_generator.get_keyring()
+    payload = jwt.decode(token, keyring.key, algorithms=['HS256'])
+    payload.update(changes)
+    return jwt.encode(payload, keyring.key, algorithm='HS256', headers={'kid': keyring.kid.hex()})
+
+
+async def async_request(method, *args):
+    return await method(*args)
+
+
 @pytest.fixture
 def client():
     return Client(enforce_csrf_checks=True)
@@ -128,8 +188,7 @@ def test_params_missing(test_user, settings, client):
 @pytest.mark.django_db
 def test_email_content(test_user, mailoutbox, settings):
     test_user.is_active = False
-    send_email(test_user, thread=True)
-    time.sleep(0.5)
+    assert send_email(test_user, thread=True).result(timeout=5)
     email = mailoutbox[0]
     email_content = email.alternatives[0][0]
     url, expiry = get_mail_params(email_content)
@@ -241,9 +300,7 @@ def test_email_wrong_user(test_user, client, mailoutbox, wrong_token_template, s
     url, _ = get_mail_params(email_content)
 
     url = url.split('/')
-    payload = jwt.decode(url[-1], settings.SECRET_KEY, algorithms=['HS256'])
-    payload.update({'email': 'noemail@test.com'})
-    url[-1] = jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+    url[-1] = resign_token(url[-1], email='noemail@test.com')
     url = '/'.join(url)
 
     response = client.get(url)
@@ -257,9 +314,7 @@ def test_email_wrong_user(test_user, client, mailoutbox, wrong_token_template, s
     url, _ = get_mail_params(email_content)
 
     url = url.split('/')
-    payload = jwt.decode(url[-1], settings.SECRET_KEY, algorithms=['HS256'])
-    payload.update({'email': 'noemail@test.com'})
-    url[-1] = jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+    url[-1] = resign_token(url[-1], email='noemail@test.com')
     url = '/'.join(url)
 
     response = client.get(url)
@@ -330,10 +385,765 @@ def test_log_malformed_link(test_user, settings):
     assert warning_raised, 'No warning raised if malformed url is not detected'
 
 
+@pytest.mark.django_db
+def test_link_checked_once(test_user, mailoutbox, settings):
+    settings.EMAIL_PAGE_DOMAIN = 'https://checked.test/'
+    with mock.patch('validators.url', return_value=True) as url:
+        send_email(test_user, thread=False)
+        send_password(test_user, thread=False)
+        send_email(test_user, thread=False)
+    assert url.call_count == 2, 'Link validated for each email'
+    assert mailoutbox[2].alternatives[0][0].count('https://checked.test/confirm/email/') > 0
+
+
+@pytest.mark.django_db
+def test_link_site_domain(test_user, mailoutbox, settings, rf):
+    settings.DEBUG = True
+    settings.EMAIL_PAGE_DOMAIN = ''
+    settings.SITE_ID = 1
+    Site.objects.filter(pk=1).update(domain='site.test')
+    Site.objects.clear_cache()
+    send_email(test_user, thread=False)
+    assert mailoutbox[0].extra_headers['LINK'].startswith('https://site.test/confirm/email/')
+
+    del settings.SITE_ID
+    settings.EMAIL_PAGE_SCHEME = 'http'
+    settings.ALLOWED_HOSTS = ['other.test']
+    Site.objects.create(domain='other.test', name='other')
+    send_email(test_user, thread=False, request=rf.get('/', HTTP_HOST='other.test'))
+    assert mailoutbox[1].extra_headers['LINK'].startswith('http://other.test/confirm/email/')
+
+
+@pytest.mark.django_db
+def test_link_prefix_cached(test_user, mailoutbox, settings):
+    get_link_prefixes('MAIL')
+    misses = link_prefix_cache_info().misses
+    for _ in range(3):
+        send_email(test_user, thread=False)
+    assert link_prefix_cache_info().misses == misses, 'The URLconf is scanned on every send'
+    assert get_link_prefixes('MAIL') == ('confirm/email/',)
+    assert get_link_prefixes('MAIL', 'django_email_verification.tests.urls_test_2') == ()
+
+    settings.ROOT_URLCONF = 'django_email_verification.tests.urls_test_1'
+    assert len(get_link_prefixes('MAIL')) == 2
+
+
+@pytest.mark.django_db
+def test_templates_cached(test_user, mailoutbox, settings):
+    send_email(test_user, thread=False)
+    misses = _get_subject_template.cache_info().misses, _get_mail_template.cache_info().misses
+    send_email(test_user, thread=False)
+    assert (_get_subject_template.cache_info().misses, _get_mail_template.cache_info().misses) == misses
+
+    settings.EMAIL_MAIL_SUBJECT = 'Changed subject {{ user.username }}'
+    assert _get_subject_template.cache_info().currsize == 0
+    send_email(test_user, thread=False)
+    assert mailoutbox[-1].subject == f'Changed subject {test_user.username}'
+
+
+@pytest.mark.urls('django_email_verification.tests.urls_test_3')
+@pytest.mark.django_db(transaction=True)
+def test_email_async(test_user, mailoutbox):
+    test_user.is_active = False
+    async_to_sync(asend_email)(test_user, thread=False)
+    url, _ = get_mail_params(mailoutbox[0].alternatives[0][0])
+    assert '/confirm/email/' in url
+
+    response = async_to_sync(async_request)(AsyncClient().get, url)
+    match = render_to_string('confirm.html', {'success': True, 'user': test_user})
+    assert response.content.decode() == match
+    assert get_user_model().objects.get(email='test@test.com').is_active
+    assert async_to_sync(averify_email)('_') == (False, None)
+
+
+@pytest.mark.urls('django_email_verification.tests.urls_test_3')
+@pytest.mark.django_db(transaction=True)
+def test_email_async_page_cache(settings):
+    settings.CACHES = {**settings.CACHES, 'db': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                 'LOCATION': 'email_verification_cache'}}
+    settings.EMAIL_TOKEN_CACHE = 'db'
+    settings.EMAIL_PAGE_CACHE_TIMEOUT = 60
+    call_command('createcachetable', 'email_verification_cache')
+    for _ in range(2):
+        response = async_to_sync(async_request)(AsyncClient().get, '/confirm/email/invalid')
+        assert b'invalid token' in response.content and 'max-age=60' in response['Cache-Control']
+    assert caches['db'].get(f'django_email_verification:page:confirm.html:{get_language()}') is not None
+
+
+@pytest.mark.urls('django_email_verification.tests.urls_test_3')
+@pytest.mark.django_db(transaction=True)
+def test_password_async(test_user, mailoutbox):
+    assert async_to_sync(asend_password)(test_user, thread=True).result(timeout=5)
+    url, _ = get_mail_params(mailoutbox[0].alternatives[0][0])
+    client = AsyncClient(enforce_csrf_checks=True)
+    response = async_to_sync(async_request)(client.get, url)
+    assert response.content.decode() == render_to_string('password_change.html', {'token': url.split('/')[-1]})
+
+    response = async_to_sync(async_request)(client.post, url, {'password': 'new_password'})
+    assert response.content.decode() == render_to_string('confirm.html', {'success': True, 'user': test_user})
+    assert get_user_model().objects.get(email='test@test.com').check_password('new_password')
+
+
+@pytest.mark.django_db
+def test_email_outbox(test_user, mailoutbox, settings, client):
+    settings.EMAIL_OUTBOX = True
+    test_user.is_active = False
+    send_email(test_user, context={'extra': 'value'})
+    send_password(test_user)
+    assert len(mailoutbox) == 0
+    assert list(OutboxEmail.objects.values_list('kind', 'context')) == [('MAIL', {'extra': 'value'}),
+                                                                         ('PASSWORD', None)]
+
+    settings.EMAIL_METRICS_HOOK = 'django_email_verification.tests.tests.recording_hook'
+    recording_hook.events.clear()
+    out = io.StringIO()
+    call_command('drain_email_outbox', stdout=out)
+    assert '2 emails sent' in out.getvalue()
+    assert [e[1:] for e in recording_hook.events if e[0] == 'increment'] == [('sent', 'MAIL'), ('sent', 'PASSWORD')]
+    assert [e[1] for e in recording_hook.events if e[0] == 'timing'][:4] == ['resolve', 'render', 'send', 'total']
+    assert [m.to for m in mailoutbox] == [[test_user.email]] * 2
+    assert not OutboxEmail.objects.exists()
+
+    url, _ = get_mail_params(mailoutbox[0].alternatives[0][0])
+    client.get(url)
+    assert get_user_model().objects.get(email='test@test.com').is_active
+
+
+@pytest.mark.django_db
+def test_email_campaign_command(mailoutbox, tmp_path):
+    users = [get_user_model().objects.create(username=f'campaign_{i}', email=f'campaign{i}@test.com',
+                                             is_active=i != 3) for i in range(7)]
+    checkpoint = tmp_path / 'checkpoint.json'
+
+    out = io.StringIO()
+    call_command('send_verification_emails', '--filter', 'is_active=true', '--exclude', 'username=campaign_0',
+                 '--batch-size', '2', '--checkpoint', str(checkpoint), stdout=out)
+    assert 'Done: 5 emails sent, 0 failed' in out.getvalue() and 'emails/s' in out.getvalue()
+    assert [m.to for m in mailoutbox] == [[u.email] for u in users if u.pk not in (users[0].pk, users[3].pk)]
+    assert json.loads(checkpoint.read_text()) == {'last_pk': users[-1].pk, 'sent': 5, 'failed': 0}
+
+    # resumed after the last user sent
+    new_user = get_user_model().objects.create(username='campaign_7', email='campaign7@test.com')
+    call_command('send_verification_emails', '--checkpoint', str(checkpoint), stdout=out)
+    assert mailoutbox[-1].to == [new_user.email] and len(mailoutbox) == 6
+
+    mailoutbox.clear()
+    for shard in ('0/3', '1/3', '2/3'):
+        call_command('send_verification_emails', '--shard', shard, '--kind', 'PASSWORD', stdout=out)
+    assert sorted(m.to[0] for m in mailoutbox) == sorted(u.email for u in users + [new_user])
+
+    with pytest.raises(CommandError):
+        call_command('send_verification_emails', '--shard', '3/3')
+
+
+@pytest.mark.django_db
+def test_email_outbox_retry(mailoutbox, settings):
+    settings.EMAIL_METRICS_HOOK = 'django_email_verification.tests.tests.recording_hook'
+    recording_hook.events.clear()
+    row = OutboxEmail.objects.create(user_pk='1234', kind='MAIL', expiry=int(time.time()) + 60)
+    assert drain_outbox(backoff=60) == (0, 1)
+    row.refresh_from_db()
+    assert (row.attempts, row.failed) == (1, False)
+    assert 'not found' in row.last_error
+    assert drain_outbox() == (0, 0), 'Retried before the backoff expired'
+
+    OutboxEmail.objects.update(next_attempt=row.created)
+    assert drain_outbox(max_attempts=2) == (0, 1)
+    row.refresh_from_db()
+    assert (row.attempts, row.failed) == (2, True)
+    assert len(mailoutbox) == 0
+    assert [e[1:] for e in recording_hook.events if e[0] == 'increment'] == [('send_retry', 'MAIL'),
+                                                                            ('send_failed', 'MAIL')]
+
+
+@pytest.mark.django_db
+def test_email_outbox_expired(test_user, mailoutbox):
+    test_user.save()
+    expired = OutboxEmail.objects.create(user_pk=str(test_user.pk), kind='MAIL', expiry=int(time.time()) - 10)
+    OutboxEmail.objects.create(user_pk=str(test_user.pk), kind='MAIL', expiry=int(time.time()) + 60)
+    assert drain_outbox() == (1, 1)
+    expired.refresh_from_db()
+    assert (expired.attempts, expired.failed) == (1, True)
+    assert 'expired' in expired.last_error
+    assert OutboxEmail.objects.count() == 1
+    assert len(mailoutbox) == 1
+
+
+@pytest.mark.django_db
+def test_email_save_user_queries(test_user, mailoutbox, settings, django_assert_num_queries):
+    settings.EMAIL_SAVE_USER = False
+    with django_assert_num_queries(1):
+        send_email(test_user, thread=False)
+    with django_assert_num_queries(0):
+        send_email(test_user, thread=False)
+
+    settings.EMAIL_SAVE_USER = ['is_active']
+    test_user.is_active = False
+    with django_assert_num_queries(1) as queries:
+        send_email(test_user, thread=False)
+    assert '"is_active"' in queries[0]['sql'] and '"password"' not in queries[0]['sql']
+    assert not get_user_model().objects.get(pk=test_user.pk).is_active
+
+    settings.EMAIL_SAVE_USER = True
+    with django_assert_num_queries(1) as queries:
+        send_email(test_user, thread=False)
+    assert '"password"' in queries[0]['sql']
+    assert len(mailoutbox) == 4
+
+
+@pytest.mark.django_db
+def test_email_verify_queries(test_user, mailoutbox, settings, django_assert_num_queries):
+    def verified_fields(user):
+        user.is_active = True
+        return ['is_active']
+
+    settings.DEBUG = True
+    settings.EMAIL_MAIL_CALLBACK = verified_fields
+    settings.EMAIL_USER_ONLY_FIELDS = ['email', 'username', 'is_active']
+    test_user.is_active = False
+    send_email(test_user, thread=False)
+    token = mailoutbox[0].extra_headers['TOKEN']
+
+    with django_assert_num_queries(2) as queries:
+        assert verify_email(token)[0]
+    assert 'LIMIT 2' in queries[0]['sql']
+    assert queries[1]['sql'].startswith('UPDATE') and '"password"' not in queries[1]['sql']
+    assert get_user_model().objects.get(pk=test_user.pk).is_active
+
+
+@pytest.mark.django_db
+def test_email_lookup_field(test_user, mailoutbox, settings):
+    settings.DEBUG = True
+    settings.EMAIL_TOKEN_LOOKUP_FIELD = 'username'
+    send_email(test_user, thread=False)
+    token = mailoutbox[0].extra_headers['TOKEN']
+    assert jwt.decode(token, options={'verify_signature': False})['username'] == test_user.username
+    assert verify_email(token) == (True, test_user)
+
+
+@pytest.mark.django_db
+def test_token_replay_cache(test_user, mailoutbox, settings, django_assert_num_queries):
+    settings.DEBUG = True
+    settings.EMAIL_TOKEN_CACHE = 'default'
+    test_user.is_active = False
+    send_email(test_user, thread=False)
+    token = mailoutbox[0].extra_headers['TOKEN']
+    assert 'jti' in jwt.decode(token, options={'verify_signature': False})
+
+    assert verify_email(token)[0]
+    with django_assert_num_queries(0):
+        assert verify_email(token) == (False, None), 'Token accepted twice'
+        assert verify_email(token) == (False, None)
+        assert verify_email('garbage') == (False, None)
+    with mock.patch('jwt.decode') as decode:
+        assert verify_email('garbage') == (False, None)
+        assert not decode.called, 'Invalid token decoded again'
+
+    send_email(test_user, thread=False)
+    token = mailoutbox[1].extra_headers['TOKEN']
+    with mock.patch.object(get_user_model(), 'save', side_effect=DatabaseError):
+        with pytest.raises(DatabaseError):
+            verify_email(token)
+    with mock.patch.object(QuerySet, 'bulk_update', side_effect=DatabaseError):
+        with pytest.raises(DatabaseError):
+            verify_email_bulk([token])
+    assert verify_password(token, 'pwd') == (False, None)
+    assert verify_email(token)[0], 'Token rejected after a check with another kind'
+
+    settings.EMAIL_TOKEN_CACHE = None
+    assert verify_email(token)[0]
+
+
+@pytest.mark.django_db
+def test_email_compact_token(test_user, mailoutbox, settings, client):
+    settings.DEBUG = True
+    settings.EMAIL_TOKEN_FORMAT = 'compact'
+    test_user.is_active = False
+    check_email_verification(test_user, mailoutbox, client)
+    token = mailoutbox[0].extra_headers['TOKEN']
+    assert len(token) < 50 and '.' not in token
+
+    send_password(test_user, thread=False)
+    password_token = mailoutbox[1].extra_headers['TOKEN']
+    assert verify_email(password_token) == (False, None), 'Password token accepted as email token'
+    tampered = password_token[:10] + ('A' if password_token[10] != 'A' else 'B') + password_token[11:]
+    assert verify_password(tampered, 'password') == (False, None), 'Tampered token accepted'
+
+    settings.EMAIL_TOKEN_FORMAT = 'jwt'
+    send_password(test_user, thread=False)
+    settings.EMAIL_TOKEN_ACCEPTED_FORMATS = ('jwt',)
+    assert verify_password(password_token, 'password') == (False, None), 'Compact token accepted'
+    assert verify_password(mailoutbox[2].extra_headers['TOKEN'], 'password')[0]
+
+    settings.EMAIL_TOKEN_FORMAT = 'compact'
+    with pytest.raises(ValueError, match='2106'):
+        default_token_generator.make_token(test_user, datetime(2107, 1, 1), kind='MAIL')
+    with pytest.raises(ValueError, match='2106'):
+        default_token_generator.make_token(test_user, -1, kind='MAIL')
+
+
+@pytest.mark.django_db
+def test_email_token_algorithm(test_user, mailoutbox, settings):
+    settings.DEBUG = True
+    settings.EMAIL_TOKEN_ALGORITHM = 'HS512'
+    send_email(test_user, thread=False)
+    token = mailoutbox[0].extra_headers['TOKEN']
+    assert jwt.get_unverified_header(token)['alg'] == 'HS512'
+    assert verify_email(token)[0]
+
+
+def test_settings_config(settings):
+    config = get_config()
+    assert get_config() is config, 'The configuration is rebuilt on every access'
+    with pytest.raises(AttributeError):
+        config.debug = False
+    assert check_settings(None) == []
+
+    settings.EMAIL_MAIL_TOKEN_LIFE = '60'
+    settings.EMAIL_TOKEN_FORMAT = 'short'
+    settings.EMAIL_TOKEN_ALGORITHM = 'RS256'
+    del settings.EMAIL_PASSWORD_HTML
+    assert get_config() is not config
+    assert get_config().kinds['MAIL'].token_life is None
+    assert get_config().kinds['PASSWORD'].missing == ('EMAIL_PASSWORD_HTML',)
+    assert sorted(e.id for e in check_settings(None)) == ['django_email_verification.E001',
+                                                          'django_email_verification.E002',
+                                                          'django_email_verification.E002',
+                                                          'django_email_verification.W001']
+    with pytest.raises(ImproperlyConfigured):
+        default_token_generator.get_algorithm()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('token_format', ['jwt', 'compact'])
+def test_token_key_rotation(test_user, mailoutbox, settings, token_format):
+    settings.DEBUG = True
+    settings.EMAIL_TOKEN_FORMAT = token_format
+    send_email(test_user, thread=False)
+    token = mailoutbox[0].extra_headers['TOKEN']
+    old_key = settings.SECRET_KEY
+
+    settings.SECRET_KEY = 'a-new-secret-key'
+    assert default_token_generator.check_token(token) == (False, None), 'Token accepted with a new key'
+    settings.SECRET_KEY_FALLBACKS = [old_key]
+    assert default_token_generator.check_token(token) == (True, test_user), 'Token rejected after a rotation'
+
+    settings.CUSTOM_SALT = 'another-salt'
+    assert default_token_generator.check_token(token) == (False, None), 'Token accepted with a different salt'
+
+    settings.EMAIL_TOKEN_KEYS = ['key-2', 'key-1']
+    token, _ = default_token_generator.make_token(test_user, int(time.time()) + 60, kind='MAIL')
+    settings.EMAIL_TOKEN_KEYS = ['key-3', 'key-2']
+    assert default_token_generator.check_token(token)[0], 'Token rejected after a rotation'
+
+
+@pytest.mark.django_db
+def test_token_legacy(test_user, settings):
+    test_user.save()
+    token = jwt.encode({'email': test_user.email, 'exp': int(time.time()) + 60}, settings.SECRET_KEY,
+                       algorithm='HS256')
+    assert default_token_generator.check_token(token) == (True, test_user), 'Token without kid rejected'
+
+
+@pytest.mark.django_db
+def test_token_signers(test_user, mailoutbox, settings):
+    keyring = default_token_generator.get_keyring()
+    payload = {'email': test_user.email, 'exp': int(time.time()) + 60, 'jti': 'abc', 'kind': 'MAIL'}
+    fast, compat = HMACSigner(), PyJWTSigner()
+    for algorithm in ('HS256', 'HS512'):
+        token = fast.encode(payload, keyring, algorithm)
+        assert token == compat.encode(payload, keyring, algorithm), 'Token different from the PyJWT one'
+        assert fast.decode(token, keyring, algorithm) == compat.decode(token, keyring, algorithm) == payload
+        assert fast.decode(token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB'), keyring, algorithm) is None
+    expired = compat.encode({**payload, 'exp': int(time.time()) - 1}, keyring, 'HS256')
+    legacy = jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+    for token in (expired, fast.encode(payload, keyring, 'HS512'), 'garbage', 'a.b.c', legacy[:-1]):
+        assert fast.decode(token, keyring, 'HS256') is None
+    assert fast.decode(legacy, keyring, 'HS256') == payload
+
+    assert isinstance(default_token_generator.get_signer(), HMACSigner)
+    settings.EMAIL_TOKEN_ALGORITHM = 'HS256'
+    settings.EMAIL_TOKEN_SIGNER = 'django_email_verification.signing.PyJWTSigner'
+    assert isinstance(default_token_generator.get_signer(), PyJWTSigner)
+    settings.DEBUG = True
+    send_email(test_user, thread=False)
+    assert verify_email(mailoutbox[0].extra_headers['TOKEN'])[0]
+
+
+def test_executor_backpressure():
+    release = threading.Event()
+    executor = SendExecutor(workers=1, queue_size=1, policy='raise')
+    executor.submit(release.wait)
+    while executor.stats()['busy'] == 0:
+        time.sleep(0.01)
+    executor.submit(release.wait)
+    with pytest.raises(SendQueueFull):
+        executor.submit(release.wait)
+    assert executor.stats()['queue_depth'] == 1
+    assert executor.stats()['utilisation'] == 1
+
+    executor.policy = 'drop'
+    assert not executor.submit(release.wait)
+    release.set()
+    executor.shutdown()
+    stats = executor.stats()
+    assert (stats['completed'], stats['dropped'], stats['alive']) == (2, 1, 0)
+
+
+def test_executor_shutdown_timeout():
+    release = threading.Event()
+    executor = SendExecutor(workers=2, queue_size=2)
+    for _ in range(4):
+        executor.submit(release.wait)
+    while executor.stats()['busy'] < 2:
+        time.sleep(0.01)
+    start = time.monotonic()
+    executor.shutdown(wait=True, timeout=0.5)
+    assert time.monotonic() - start < 1, 'Shutdown not bounded by the timeout'
+    assert executor.stats()['alive'] == 2
+
+    release.set()
+    for t in executor._threads:
+        t.join(5)
+    stats = executor.stats()
+    assert (stats['completed'], stats['alive']) == (4, 0), 'Queue not drained after the shutdown'
+
+
+def test_executor_exit_timeout(settings):
+    settings.EMAIL_SEND_DRAIN_TIMEOUT = 5
+    with mock.patch('django_email_verification.executor.shutdown_executor') as shutdown:
+        _shutdown_at_exit()
+    shutdown.assert_called_once_with(wait=True, timeout=5)
+
+
+@pytest.mark.django_db
+def test_email_bulk(mailoutbox):
+    users = [get_user_model()(username=f'bulk_user_{i}', email=f'bulk{i}@test.com') for i in range(5)]
+    results = send_email_bulk(users[:2] + [None] + users[2:], chunk_size=2, context={'extra': 1})
+    assert [r.user for r in results] == users[:2] + [None] + users[2:]
+    assert isinstance(results[2].error, AttributeError)
+    assert all(r.error is None and r.token for i, r in enumerate(results) if i != 2)
+    assert [m.to for m in mailoutbox] == [[u.email] for u in users]
+    assert all(r.token in m.body for r, m in zip(results[:2] + results[3:], mailoutbox))
+
+    results = send_password_bulk(users[:1])
+    assert results[0].error is None and len(mailoutbox) == 6
+
+
+@pytest.mark.django_db
+def test_email_context_providers(test_user, mailoutbox, settings):
+    calls = []
+
+    def brand():
+        calls.append(threading.current_thread())
+        return {'name': 'Brand'}
+
+    def unused(user):
+        raise AssertionError('Unused context value evaluated')
+
+    settings.EMAIL_MAIL_SUBJECT = '{{ greeting }} {{ brand.name }}'
+    context = {'greeting': per_user(lambda user: f'Hi {user.username}'), 'brand': shared(brand),
+               'unused': per_user(unused)}
+    users = [get_user_model()(username=f'context_user_{i}', email=f'context{i}@test.com') for i in range(3)]
+    results = send_email_bulk(users, context=context)
+    assert all(r.error is None for r in results)
+    assert [m.subject for m in mailoutbox] == [f'Hi context_user_{i} Brand' for i in range(3)]
+    assert len(calls) == 1, 'Shared context computed for each user'
+    assert list(context) == ['greeting', 'brand', 'unused'], 'Context modified'
+
+    context = {'greeting': 'Hello', 'brand': shared(brand)}
+    send_email(test_user, context=context).result(timeout=5)
+    assert mailoutbox[-1].subject == 'Hello Brand' and list(context) == ['greeting', 'brand']
+    assert calls[-1] is not threading.current_thread(), 'Context evaluated on the caller thread'
+
+    send_email(test_user, thread=False, context=lambda user: {'greeting': user.email, 'brand': {'name': 'B'}})
+    assert mailoutbox[-1].subject == f'{test_user.email} B'
+
+
+@pytest.mark.urls('django_email_verification.tests.urls_test_2')
+@pytest.mark.django_db
+def test_email_bulk_no_view(test_user, mailoutbox):
+    results = send_email_bulk([test_user])
+    assert results[0].error is not None and results[0].token is None
+    assert len(mailoutbox) == 0
+
+
+@pytest.mark.django_db
+def test_email_verify_bulk(mailoutbox, settings, django_assert_num_queries):
+    def verified_fields(user):
+        user.is_active = True
+        return ['is_active']
+
+    settings.EMAIL_MAIL_CALLBACK = verified_fields
+    users = [get_user_model().objects.create(username=f'bulk_user_{i}', email=f'bulk{i}@test.com', is_active=False)
+             for i in range(4)]
+    tokens = [r.token for r in send_email_bulk(users)]
+    tokens = tokens[:3] + ['garbage', tokens[0]]
+
+    with django_assert_num_queries(2) as queries:
+        results = verify_email_bulk(tokens)
+    assert ' IN (' in queries[0]['sql']
+    assert queries[1]['sql'].startswith('UPDATE') and '"password"' not in queries[1]['sql']
+    assert [r.token for r in results] == tokens
+    assert [r.success for r in results] == [True, True, True, False, False]
+    assert [r.user for r in results[:3]] == users[:3] and results[3].user is None
+    assert [u.is_active for u in get_user_model().objects.order_by('pk')] == [True, True, True, False]
+
+    settings.EMAIL_TOKEN_CACHE = 'default'
+    results = verify_email_bulk([r.token for r in send_email_bulk(users[3:])] * 2)
+    assert [r.success for r in results] == [True, False], 'Token accepted twice'
+
+
+@pytest.mark.django_db
+def test_email_rate_limit(test_user, mailoutbox, settings, rf):
+    caches['default'].clear()
+    settings.EMAIL_RATE_LIMITS = {'email': '2/h', 'ip': (3, 60)}
+    request = rf.get('/', REMOTE_ADDR='10.0.0.1')
+    assert send_email(test_user, thread=False, request=request).reason is None
+    assert send_email(test_user, thread=False, request=request).reason is None
+    assert send_email(test_user, thread=False, request=request).reason == REJECTED_EMAIL
+    assert len(mailoutbox) == 2
+
+    other = get_user_model().objects.create(username='rate_user', email='rate@test.com')
+    assert send_password(other, thread=False, request=request).reason is None
+    assert send_password(other, thread=False, request=request).reason == REJECTED_IP
+    assert send_password(other, thread=False).reason is None, 'IP limit applied without a request'
+    assert len(mailoutbox) == 4
+
+    settings.EMAIL_RATE_LIMITS = {'email': '2/h'}
+    settings.EMAIL_DEDUP_WINDOW = 60
+    caches['default'].clear()
+    assert send_email(test_user, thread=False).reason is None
+    assert send_email(test_user, thread=False).reason == REJECTED_DUPLICATE
+    assert get_outstanding(test_user, 'MAIL')[0] in mailoutbox[-1].body
+    assert send_password(test_user, thread=False).reason is None, 'Dedup shared between kinds'
+
+    caches['default'].clear()
+    settings.EMAIL_SEND_RETRIES = 0
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=smtplib.SMTPServerDisconnected):
+        assert send_email(test_user, thread=False).exception() is not None
+    assert send_email(test_user, thread=False).reason is None, 'Failed email counted as a duplicate'
+
+    caches['default'].clear()
+    assert check_send(test_user, 'MAIL') is None
+    assert check_send(test_user, 'MAIL') == REJECTED_DUPLICATE, 'Dedup window not claimed by the check'
+
+    settings.EMAIL_DEDUP_WINDOW = None
+    settings.EMAIL_RATE_LIMITS = {'email': '1/h'}
+    caches['default'].clear()
+    settings.EMAIL_MAIL_TOKEN_LIFE = None
+    settings.EMAIL_TOKEN_LIFE = None
+    with pytest.raises(NotAllFieldCompiled):
+        send_email(test_user, thread=False)
+    settings.EMAIL_MAIL_TOKEN_LIFE = 60
+    assert send_email(test_user, thread=False).reason is None, 'Misconfigured send counted'
+    assert send_email(test_user, thread=False).reason == REJECTED_EMAIL
+
+    settings.EMAIL_RATE_LIMITS = {'email': '1/h', 'user': '1/h'}
+    caches['default'].clear()
+    assert check_send(other, 'MAIL') is None
+    other.email = 'other@test.com'
+    assert check_send(other, 'MAIL') == REJECTED_USER
+    assert check_send(get_user_model()(email='other@test.com'), 'MAIL') is None, 'Rejected send counted'
+
+    settings.EMAIL_RATE_LIMITS = {'phone': '1/h'}
+    assert [e.id for e in check_settings(None)] == ['django_email_verification.E003']
+
+
+@pytest.mark.django_db
+def test_email_signals_metrics(test_user, mailoutbox, settings):
+    settings.DEBUG = True
+    settings.EMAIL_METRICS_HOOK = 'django_email_verification.tests.tests.recording_hook'
+    settings.EMAIL_SEND_RETRIES = 0
+    recording_hook.events.clear()
+    events = []
+
+    def record(signal, **kwargs):
+        events.append((signal, kwargs['kind'], kwargs.get('stage')))
+
+    for signal in (verification_email_sent, verification_failed, token_verified):
+        signal.connect(record, weak=False)
+    try:
+        send_email(test_user, thread=False)
+        token = mailoutbox[0].extra_headers['TOKEN']
+        assert verify_email(token)[0]
+        assert not verify_email('garbage')[0]
+        with mock.patch.object(DjangoTransport, 'send_messages', side_effect=OSError):
+            send_password(test_user, thread=False)
+    finally:
+        for signal in (verification_email_sent, verification_failed, token_verified):
+            signal.disconnect(record)
+
+    assert events == [(verification_email_sent, 'MAIL', None), (token_verified, 'MAIL', None),
+                      (verification_failed, 'MAIL', 'verify'), (verification_failed, 'PASSWORD', 'send')]
+    stages = [e[1] for e in recording_hook.events if e[0] == 'timing']
+    assert stages[:6] == ['save', 'resolve', 'render', 'send', 'total', 'decode'] and 'lookup' in stages
+    assert [e[1:] for e in recording_hook.events if e[0] == 'increment'] == [
+        ('sent', 'MAIL'), ('verified', 'MAIL'), ('verify_failed', 'MAIL'), ('send_failed', 'PASSWORD')]
+
+
+def test_import_time():
+    # python -X importtime reports every module imported, and its cumulative time in us, on stderr
+    # the package is imported first, since the modules imported by django.setup() are not reported
+    code = 'import django_email_verification; import django; django.setup()'
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'django_email_verification.tests.settings'}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                            text=True, check=True)
+    modules = {line.split('|')[-1].strip(): int(line.split('|')[1]) for line in result.stderr.splitlines()
+               if line.startswith('import time:') and line.split('|')[1].strip().isdigit()}
+    assert 'django_email_verification' in modules
+    for module in ('jwt', 'validators', 'deprecation', 'django_email_verification.confirm',
+                   'django_email_verification.token_utils'):
+        assert module not in modules, f'{module} imported at startup'
+    assert modules['django_email_verification'] < 100000, \
+        f'django_email_verification imported in {modules["django_email_verification"]} us'
+
+    # the heavy dependencies are not needed to load the sending functions either
+    code += '; from django_email_verification import send_email'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                            text=True, check=True)
+    assert 'django_email_verification.token_utils' in result.stderr
+    assert not re.search(r'\| +(jwt|validators|deprecation)$', result.stderr, re.MULTILINE)
+
+
+@pytest.mark.django_db
+def test_email_transport(test_user, mailoutbox, settings):
+    settings.EMAIL_TRANSPORT = 'django_email_verification.transport.FakeTransport'
+    settings.EMAIL_TRANSPORT_OPTIONS = {'latency': 0.01}
+    send_email(test_user, thread=False)
+    send_email_bulk([test_user, test_user])
+    transport = get_transport()
+    assert isinstance(transport, FakeTransport) and transport.sent == 3 and len(mailoutbox) == 0
+    assert transport.messages[0].to == [test_user.email]
+
+    settings.EMAIL_TRANSPORT = 'django_email_verification.transport.PooledTransport'
+    settings.EMAIL_TRANSPORT_OPTIONS = {'keepalive': 60}
+    send_email(test_user, thread=False)
+    connection = get_transport()._local.connection
+    with mock.patch.object(connection, 'send_messages', side_effect=smtplib.SMTPServerDisconnected):
+        send_email(test_user, thread=False)
+    assert get_transport()._local.connection is not connection, 'Connection not opened again after an error'
+    send_email(test_user, thread=False)
+    assert len(mailoutbox) == 3
+
+
+def test_send_error_classification():
+    assert isinstance(classify_error(smtplib.SMTPResponseException(421, b'busy')), TransientSendError)
+    assert isinstance(classify_error(TimeoutError()), TransientSendError)
+    assert isinstance(classify_error(smtplib.SMTPRecipientsRefused({'a@test.com': (550, b'no')})),
+                      PermanentSendError)
+    assert isinstance(classify_error(smtplib.SMTPAuthenticationError(535, b'auth')), SendConfigurationError)
+    assert isinstance(classify_error(NotAllFieldCompiled()), SendConfigurationError)
+
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow() and breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.allow() and not breaker.allow(), 'More than one trial send while half open'
+    breaker.success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_email_retry(test_user, settings):
+    settings.EMAIL_SEND_RETRY_BACKOFF = 0.01
+    with mock.patch.object(DjangoTransport, 'send_messages',
+                           side_effect=[smtplib.SMTPResponseException(421, b'busy'), TimeoutError(), 1]) as send:
+        result = send_email(test_user)
+        assert result.result(timeout=5) is True and send.call_count == 3
+    assert executor_stats()['retried'] == 2
+
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=TimeoutError) as send:
+        result = send_email(test_user, thread=False)
+        assert isinstance(result.exception(), TransientSendError) and send.call_count == 1, 'Retried in the caller'
+
+    refused = smtplib.SMTPRecipientsRefused({test_user.email: (550, b'unknown user')})
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=refused) as send:
+        result = send_email(test_user, thread=False)
+        assert isinstance(result.exception(), PermanentSendError) and send.call_count == 1
+
+    settings.EMAIL_SEND_RETRIES = 0
+    settings.EMAIL_SEND_CIRCUIT_THRESHOLD = 2
+    with mock.patch('django_email_verification.confirm.render_templates', side_effect=TemplateDoesNotExist('x')):
+        results = [send_email(test_user, thread=False) for _ in range(2)]
+        assert isinstance(results[1].exception(), SendConfigurationError)
+    assert get_circuit_breaker().state == 'closed', 'Configuration error opened the circuit'
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=ConnectionError) as send:
+        results = [send_email(test_user, thread=False) for _ in range(3)]
+        assert isinstance(results[2].exception(), CircuitOpen) and send.call_count == 2
+
+    # a half open circuit is closed by any reply of the backend, even a refused recipient
+    settings.EMAIL_SEND_CIRCUIT_THRESHOLD = 1
+    settings.EMAIL_SEND_CIRCUIT_RESET = 0.05
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=ConnectionError):
+        send_email(test_user, thread=False)
+    assert get_circuit_breaker().state == 'open'
+    time.sleep(0.06)
+    with mock.patch.object(DjangoTransport, 'send_messages', side_effect=refused):
+        assert isinstance(send_email(test_user, thread=False).exception(), PermanentSendError)
+    assert get_circuit_breaker().state == 'closed'
+    assert send_email(test_user, thread=False).result() is True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_email_handle(mailoutbox, settings):
+    users = [get_user_model().objects.create(username=f'handle_user_{i}', email=f'handle{i}@test.com')
+             for i in range(5)]
+    results = [send_email(user) for user in users]
+    done, not_done = wait(results, timeout=5)
+    assert len(done) == 5 and not not_done
+    assert all(r.result() is True and r.token and r.expiry for r in results)
+    assert sorted(r.token for r in as_completed(results)) == sorted(r.token for r in results)
+    bodies = {m.to[0]: m.body for m in mailoutbox}
+    assert all(r.token in bodies[u.email] for r, u in zip(results, users))
+
+    settings.EMAIL_DEDUP_WINDOW = 60
+    caches['default'].clear()
+    first = send_email(users[0], thread=False)
+    duplicate = send_email(users[0], thread=False)
+    assert duplicate.rejected and duplicate.result() is False
+    assert (duplicate.token, duplicate.expiry) == (first.token, first.expiry)
+
+
+@pytest.mark.django_db
+def test_email_view_prefetch(test_user, mailoutbox, settings, client, django_assert_num_queries):
+    settings.DEBUG = True
+    test_user.is_active = False
+    send_email(test_user, thread=False)
+    link = mailoutbox[0].extra_headers['LINK'].replace('https://test.com', '')
+
+    with django_assert_num_queries(0):
+        assert client.head(link).status_code == 200
+        response = client.get(link, HTTP_USER_AGENT='Mozilla/5.0 (compatible; BingPreview/1.0b)')
+        assert response.content == b'' and 'no-store' in response['Cache-Control']
+        assert client.get(link, HTTP_SEC_PURPOSE='prefetch').content == b''
+    test_user.refresh_from_db()
+    assert not test_user.is_active, 'Token consumed by a prefetch'
+
+    settings.EMAIL_MAIL_CONFIRM_PAGE_TEMPLATE = 'confirm_interstitial.html'
+    assert b'<form' in client.get(link).content
+    test_user.refresh_from_db()
+    assert not test_user.is_active, 'Token consumed without the confirmation'
+    response = client.post(link)
+    assert b'your account was confirmed' in response.content and 'private' in response['Cache-Control']
+    test_user.refresh_from_db()
+    assert test_user.is_active
+
+    settings.EMAIL_PAGE_CACHE_TIMEOUT = 60
+    caches['default'].clear()
+    with mock.patch('django_email_verification.views.render_to_string', wraps=render_to_string) as render:
+        assert 'max-age=60' in client.post('/confirm/email/invalid').headers['Cache-Control']
+        assert 'request' not in render.call_args.args[1], 'Cached failure page rendered with the request'
+    with django_assert_num_queries(0), mock.patch('django_email_verification.views.render_to_string') as render:
+        assert b'invalid token' in client.post('/confirm/email/other').content
+        assert not render.called, 'Failure page rendered again'
+
+
 @pytest.mark.django_db
 def test_password_content(test_user, mailoutbox, settings):
-    send_password(test_user, thread=True)
-    time.sleep(0.5)
+    assert send_password(test_user, thread=True).result(timeout=5)
     email = mailoutbox[0]
     email_content = email.alternatives[0][0]
     url, expiry = get_mail_params(email_content)
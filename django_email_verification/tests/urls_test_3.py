@@ -0,0 +1,7 @@
+from django.urls import path, include
+
+from django_email_verification import async_urls
+
+urlpatterns = [
+    path('confirm/', include(async_urls)),
+]
@@ -1,8 +1,38 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import struct
 from datetime import datetime
+from typing import Any, Mapping, NamedTuple
 
-import jwt
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.utils.crypto import salted_hmac
+
+from .conf import TOKEN_ALGORITHMS, get_config
+from .metrics import get_metrics
+from .signing import get_signer
+
+COMPACT_VERSION = 2
+COMPACT_KINDS = ('MAIL', 'PASSWORD')
+# version, kind, expiry, jti and, from version 2, the key id
+COMPACT_HEADERS = {1: struct.Struct('>BBI6s'), 2: struct.Struct('>BBI6s4s')}
+# the expiry is an unsigned 32 bit timestamp, from 1970 to February 2106
+COMPACT_MAX_EXPIRY = 2 ** 32 - 1
+COMPACT_MAC_SIZE = 16
+KID_SIZE = 4
+
+
+class Keyring(NamedTuple):
+    config: Any
+    salt: str
+    kid: bytes
+    key: bytes
+    keys: Mapping[bytes, bytes]
+    legacy: tuple
 
 
 class EmailVerificationTokenGenerator:
@@ -10,12 +40,10 @@ class EmailVerificationTokenGenerator:
     Strategy object used to generate and check tokens for the password
     reset mechanism.
     """
-    try:
-        key_salt = settings.CUSTOM_SALT
-    except AttributeError:
-        key_salt = "django-email-verification.token"
+    key_salt = None
     algorithm = None
-    secret = settings.SECRET_KEY
+    signer = None
+    _keyring = None
 
     def make_token(self, user, expiry, **kwargs):
         """
@@ -33,9 +61,15 @@ class EmailVerificationTokenGenerator:
                 expiry (datetime): the expiry datetime
         """
         exp = int(expiry.timestamp()) if isinstance(expiry, datetime) else expiry
-        payload = {'email': user.email, 'exp': exp}
+        if get_config().token_format == 'compact':
+            return self._make_compact_token(user, int(exp), **kwargs), datetime.fromtimestamp(exp)
+        field = self.lookup_field()
+        value = getattr(user, field)
+        payload = {field: value if isinstance(value, (str, int)) else str(value), 'exp': exp,
+                   'jti': secrets.token_urlsafe(9)}
         payload.update(**kwargs)
-        return jwt.encode(payload, self.secret, algorithm='HS256'), datetime.fromtimestamp(exp)
+        keyring = self.get_keyring()
+        return self.get_signer().encode(payload, keyring, self.get_algorithm()), datetime.fromtimestamp(exp)
 
     def check_token(self, token, **kwargs):
         """
@@ -50,24 +84,343 @@ class EmailVerificationTokenGenerator:
                 user (Model): the user model if the token is valid
         """
 
+        valid, user, _ = self._check(token, kwargs)
+        return valid, user
+
+    async def acheck_token(self, token, **kwargs):
+        """
+        Same as check_token(), but the user is fetched through the async ORM.
+        """
+
+        valid, user, _ = await self._acheck(token, kwargs)
+        return valid, user
+
+    def consume_token(self, token, **kwargs):
+        """
+        Same as check_token(), but if EMAIL_TOKEN_CACHE is set the token is marked as used,
+        and it will be rejected by any later check until it expires.
+        """
+
+        valid, user, payload = self._check(token, kwargs)
+        if valid and (cache := self._get_cache()) is not None and 'jti' in payload:
+            valid = cache.add(self._used_key(payload), True, self._remaining(payload))
+        return (True, user) if valid else (False, None)
+
+    async def aconsume_token(self, token, **kwargs):
+        """
+        Same as consume_token(), but the user is fetched through the async ORM.
+        """
+
+        valid, user, payload = await self._acheck(token, kwargs)
+        if valid and (cache := self._get_cache()) is not None and 'jti' in payload:
+            valid = await cache.aadd(self._used_key(payload), True, self._remaining(payload))
+        return (True, user) if valid else (False, None)
+
+    def release_token(self, token, **kwargs):
+        """
+        Undo consume_token(), so that the token is accepted again: used when the changes made by the verification
+        could not be saved.
+        """
+
+        if (cache := self._get_cache()) is not None:
+            cache.delete_many(self._get_used_keys([token], kwargs))
+
+    async def arelease_token(self, token, **kwargs):
+        """
+        Same as release_token(), through the async cache API.
+        """
+
+        if (cache := self._get_cache()) is not None:
+            await cache.adelete_many(self._get_used_keys([token], kwargs))
+
+    def release_tokens(self, tokens, **kwargs):
+        """
+        Same as release_token() for many tokens.
+        """
+
+        if (cache := self._get_cache()) is not None:
+            cache.delete_many(self._get_used_keys(tokens, kwargs))
+
+    def _get_used_keys(self, tokens, kwargs):
+        payloads = (self._check_payload(token, **kwargs) for token in tokens)
+        return [self._used_key(payload) for payload in payloads if payload is not None and 'jti' in payload]
+
+    def check_tokens(self, tokens, **kwargs):
+        """
+        Same as check_token() for many tokens: they are all decoded first, then the users are fetched with a single
+        query for each lookup field.
+
+        Args:
+            tokens (list[str]): the tokens
+            kwargs: the extra required payload
+
+        Returns:
+            (list[tuple]): a (valid, user) tuple for each token, in the same order
+        """
+        return [(valid, user) for valid, user, _ in self._check_many(tokens, kwargs)]
+
+    def consume_tokens(self, tokens, **kwargs):
+        """
+        Same as consume_token() for many tokens, see check_tokens(). A token repeated in the list is valid once.
+        """
+        cache = self._get_cache()
+        results = []
+        consumed = set()
+        for valid, user, payload in self._check_many(tokens, kwargs):
+            if valid and 'jti' in payload:
+                valid = payload['jti'] not in consumed
+                consumed.add(payload['jti'])
+                if valid and cache is not None:
+                    valid = cache.add(self._used_key(payload), True, self._remaining(payload))
+            results.append((True, user) if valid else (False, None))
+        return results
+
+    def _check_many(self, tokens, kwargs):
+        cache = self._get_cache()
+        invalid = cache.get_many([self._invalid_key(t, kwargs) for t in tokens]) if cache is not None else {}
+        metrics, kind = get_metrics(), kwargs.get('kind', 'ANY')
+        with metrics.timer('decode', kind):
+            payloads = [self._check_payload(t, **kwargs) if self._invalid_key(t, kwargs) not in invalid else None
+                        for t in tokens]
+        if cache is not None:
+            used = cache.get_many([self._used_key(p) for p in payloads if p is not None and 'jti' in p])
+            payloads = [None if p is not None and 'jti' in p and self._used_key(p) in used else p for p in payloads]
+
+        # a query for each lookup field, the compact tokens use the pk
+        users = {}
+        with metrics.timer('lookup', kind):
+            for field in {self._lookup_field(p) for p in payloads if p is not None}:
+                values = {p[field] for p in payloads if p is not None and self._lookup_field(p) == field}
+                try:
+                    for user in self._get_user_queryset().filter(**{f'{field}__in': values}).order_by('pk'):
+                        users.setdefault((field, str(getattr(user, field))), []).append(user)
+                except (ValueError, ValidationError):
+                    continue
+
+        results = []
+        for token, payload in zip(tokens, payloads):
+            valid, user = False, None
+            if payload is not None:
+                field = self._lookup_field(payload)
+                valid, user = self._select_user(users.get((field, str(payload[field])), []))
+            results.append((valid, user, payload if valid else None))
+
+        if cache is not None:
+            rejected = {self._invalid_key(t, kwargs) for t, (valid, *_) in zip(tokens, results) if not valid}
+            if rejected:
+                cache.set_many(dict.fromkeys(rejected, True), self._negative_timeout())
+        return results
+
+    def _check(self, token, kwargs):
+        cache = self._get_cache()
+        if cache is not None and cache.get(self._invalid_key(token, kwargs)):
+            return False, None, None
+
+        metrics, kind = get_metrics(), kwargs.get('kind', 'ANY')
+        with metrics.timer('decode', kind):
+            payload = self._check_payload(token, **kwargs)
+        if payload is not None and (cache is None or 'jti' not in payload or not cache.get(self._used_key(payload))):
+            try:
+                with metrics.timer('lookup', kind):
+                    valid, user = self._select_user(list(self._get_users(payload)))
+            except (ValueError, ValidationError):
+                valid, user = False, None
+            if valid:
+                return True, user, payload
+
+        if cache is not None:
+            cache.set(self._invalid_key(token, kwargs), True, self._negative_timeout())
+        return False, None, None
+
+    async def _acheck(self, token, kwargs):
+        cache = self._get_cache()
+        if cache is not None and await cache.aget(self._invalid_key(token, kwargs)):
+            return False, None, None
+
+        metrics, kind = get_metrics(), kwargs.get('kind', 'ANY')
+        with metrics.timer('decode', kind):
+            payload = self._check_payload(token, **kwargs)
+        if payload is not None and (cache is None or 'jti' not in payload or
+                                    not await cache.aget(self._used_key(payload))):
+            try:
+                with metrics.timer('lookup', kind):
+                    valid, user = self._select_user([user async for user in self._get_users(payload)])
+            except (ValueError, ValidationError):
+                valid, user = False, None
+            if valid:
+                return True, user, payload
+
+        if cache is not None:
+            await cache.aset(self._invalid_key(token, kwargs), True, self._negative_timeout())
+        return False, None, None
+
+    @staticmethod
+    def lookup_field():
+        """
+        Returns:
+            (str): the user field stored in the token and used to find the user, EMAIL_TOKEN_LOOKUP_FIELD or 'email'
+        """
+        return get_config().token_lookup_field
+
+    def get_algorithm(self):
+        """
+        Returns:
+            (str): the JWT algorithm, the algorithm attribute if set, otherwise EMAIL_TOKEN_ALGORITHM or 'HS256'
+        """
+        algorithm = self.algorithm or get_config().token_algorithm
+        if algorithm not in TOKEN_ALGORITHMS:
+            raise ImproperlyConfigured(f'The token algorithm must be one of {TOKEN_ALGORITHMS}, not {algorithm!r}')
+        return algorithm
+
+    def get_signer(self):
+        """
+        Returns:
+            (Signer): the signer of the JWT tokens, the signer attribute if set, otherwise the one selected by
+                EMAIL_TOKEN_SIGNER
+        """
+        return self.signer or get_signer()
+
+    def get_keyring(self):
+        """
+        Return the signing keys, derived from the salt and from EMAIL_TOKEN_KEYS, or SECRET_KEY and
+        SECRET_KEY_FALLBACKS. They are derived on first use and again after the settings change.
+
+        Returns:
+            (Keyring): the id and key used to sign, all the keys accepted by id and the raw secrets used by the
+                tokens created before the keys were derived
+        """
+        config = get_config()
+        salt = self.key_salt or config.key_salt
+        keyring = self._keyring
+        if keyring is None or keyring.config is not config or keyring.salt != salt:
+            secret_keys = config.token_keys or (settings.SECRET_KEY, *getattr(settings, 'SECRET_KEY_FALLBACKS', ()))
+            keys = {}
+            for secret in secret_keys:
+                key = salted_hmac(salt, 'django_email_verification', secret=secret, algorithm='sha512').digest()
+                keys.setdefault(hashlib.sha256(key).digest()[:KID_SIZE], key)
+            kid = next(iter(keys))
+            keyring = self._keyring = Keyring(config, salt, kid, keys[kid], keys, tuple(secret_keys))
+        return keyring
+
+    def _make_compact_token(self, user, exp, kind=None, **kwargs):
+        # header and user pk, followed by a truncated HMAC-SHA256 of both
+        if kwargs or kind not in COMPACT_KINDS:
+            raise ValueError('Compact tokens support only the MAIL and PASSWORD kinds as payload')
+        if not 0 <= exp <= COMPACT_MAX_EXPIRY:
+            raise ValueError(f'Compact tokens support only expiries between 1970 and 2106, not {exp}')
+        pk = user.pk
+        if isinstance(pk, int):
+            pk = b'\x00' + pk.to_bytes((pk.bit_length() + 7) // 8 or 1, 'big')
+        else:
+            pk = b'\x01' + str(pk).encode()
+        keyring = self.get_keyring()
+        data = COMPACT_HEADERS[COMPACT_VERSION].pack(COMPACT_VERSION, COMPACT_KINDS.index(kind), exp,
+                                                     secrets.token_bytes(6), keyring.kid) + pk
+        return base64.urlsafe_b64encode(data + self._compact_mac(data, keyring.key)).rstrip(b'=').decode()
+
+    def _check_compact_token(self, token):
         try:
-            payload = jwt.decode(token, self.secret, algorithms=['HS256'])
-            email, exp = payload['email'], payload['exp']
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except ValueError:
+            return None
+        data, mac = raw[:-COMPACT_MAC_SIZE], raw[-COMPACT_MAC_SIZE:]
+        header = COMPACT_HEADERS.get(data[0]) if data else None
+        if header is None or len(data) <= header.size:
+            return None
+        version, kind, exp, jti, *kid = header.unpack_from(data)
+        keyring = self.get_keyring()
+        if kid:
+            key = keyring.keys.get(kid[0])
+            keys = (key,) if key is not None else ()
+        else:
+            keys = tuple(secret.encode() for secret in keyring.legacy)
+        if not any(hmac.compare_digest(mac, self._compact_mac(data, key)) for key in keys):
+            return None
+        if kind >= len(COMPACT_KINDS) or exp < self.now():
+            return None
+        pk = data[header.size:]
+        pk = int.from_bytes(pk[1:], 'big') if pk[0] == 0 else pk[1:].decode()
+        return {'pk': pk, 'exp': exp, 'jti': base64.urlsafe_b64encode(jti).decode(), 'kind': COMPACT_KINDS[kind]}
+
+    @staticmethod
+    def _compact_mac(data, key):
+        return hmac.new(key, data, hashlib.sha256).digest()[:COMPACT_MAC_SIZE]
+
+    def _decode_jwt(self, token):
+        return self.get_signer().decode(token, self.get_keyring(), self.get_algorithm())
+
+    def _get_formats(self):
+        return get_config().token_accepted_formats
+
+    def _check_payload(self, token, **kwargs):
+        try:
+            if '.' not in token:
+                payload = self._check_compact_token(token) if 'compact' in self._get_formats() else None
+            elif 'jwt' in self._get_formats():
+                payload = self._decode_jwt(token)
+            else:
+                payload = None
+            if payload is None or self._lookup_field(payload) not in payload:
+                return None
 
             for k, v in kwargs.items():
                 if payload[k] != v:
-                    return False, None
+                    return None
+        except (ValueError, KeyError, TypeError):
+            return None
 
-            if hasattr(settings, 'EMAIL_MULTI_USER') and settings.EMAIL_MULTI_USER:
-                users = get_user_model().objects.filter(email=email)
-            else:
-                users = [get_user_model().objects.get(email=email)]
-        except (ValueError, get_user_model().DoesNotExist, jwt.DecodeError, jwt.ExpiredSignatureError):
-            return False, None
+        return payload
 
-        if not len(users) or users[0] is None:
-            return False, None
+    @staticmethod
+    def _get_cache():
+        alias = get_config().token_cache
+        return caches[alias] if alias else None
 
+    @staticmethod
+    def _negative_timeout():
+        return get_config().token_negative_timeout
+
+    @staticmethod
+    def _invalid_key(token, kwargs):
+        # the token is rejected only for the same required payload, a mail token checked as a password token is still
+        # valid as a mail token
+        required = ':'.join(f'{k}={v}' for k, v in sorted(kwargs.items()))
+        return f'django_email_verification:invalid:{hashlib.sha256(f"{token}|{required}".encode()).hexdigest()}'
+
+    @staticmethod
+    def _used_key(payload):
+        return f'django_email_verification:used:{payload["jti"]}'
+
+    def _remaining(self, payload):
+        # the used marker is needed only until the token expires
+        return max(int(payload['exp'] - self.now()), 1)
+
+    @staticmethod
+    def _multi_user():
+        return get_config().multi_user
+
+    def _lookup_field(self, payload):
+        # compact tokens always identify the user by pk
+        return 'pk' if 'pk' in payload else self.lookup_field()
+
+    def _get_users(self, payload):
+        field = self._lookup_field(payload)
+        users = self._get_user_queryset().filter(**{field: payload[field]})
+        # With EMAIL_MULTI_USER the first user is taken, otherwise a second row makes the token ambiguous
+        return users.order_by('pk')[:1] if self._multi_user() else users[:2]
+
+    @staticmethod
+    def _get_user_queryset():
+        users = get_user_model().objects.all()
+        if only := get_config().user_only_fields:
+            users = users.only(*only)
+        if select_related := get_config().user_select_related:
+            users = users.select_related(*select_related)
+        return users
+
+    def _select_user(self, users):
+        if len(users) == 0 or (len(users) > 1 and not self._multi_user()):
+            return False, None
         return True, users[0]
 
     @staticmethod
@@ -0,0 +1,232 @@
+import atexit
+import smtplib
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .conf import get_config
+
+# errors after which a pooled connection is considered dead and opened again
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class Transport:
+    """
+    Delivers the messages built by the app. Subclasses implement send_messages().
+
+    A transport is shared by all the threads, and it can be used as a context manager around a group of sends
+    (a bulk send or an outbox batch), to keep the same connection for the whole group.
+    """
+
+    def send_messages(self, messages):
+        """
+        Args:
+            messages (list[EmailMessage]): the messages
+
+        Returns:
+            (int): the number of messages sent
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the connections held by the transport.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class DjangoTransport(Transport):
+    """
+    Send through a Django email backend, EMAIL_BACKEND by default, opening a connection for each send or group of
+    sends.
+    """
+
+    def __init__(self, backend=None, **kwargs):
+        self.backend = backend
+        self.kwargs = kwargs
+        self._local = threading.local()
+
+    def get_connection(self):
+        from django.core.mail import get_connection
+        return get_connection(self.backend, **self.kwargs)
+
+    def send_messages(self, messages):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection.send_messages(messages)
+        with self.get_connection() as connection:
+            return connection.send_messages(messages)
+
+    def __enter__(self):
+        self._local.connection = self.get_connection()
+        self._local.connection.open()
+        return self
+
+    def __exit__(self, *exc):
+        connection, self._local.connection = self._local.connection, None
+        connection.close()
+
+
+class PooledTransport(DjangoTransport):
+    """
+    Keep an open connection of the Django backend for each thread (so for each worker of the send executor), reused
+    by all the messages sent by the thread. The connection is opened again when it has been idle for more than
+    keepalive seconds, since the SMTP servers drop the idle clients, and after a connection error, in which case the
+    send is retried once.
+    """
+
+    def __init__(self, backend=None, keepalive=60, **kwargs):
+        super().__init__(backend, **kwargs)
+        self.keepalive = keepalive
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def send_messages(self, messages):
+        for retry in (False, True):
+            connection = self._get_pooled_connection()
+            try:
+                sent = connection.send_messages(messages)
+            except CONNECTION_ERRORS:
+                self._discard()
+                if retry:
+                    raise
+                continue
+            self._local.last_used = time.monotonic()
+            return sent
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def _get_pooled_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and time.monotonic() - self._local.last_used > self.keepalive:
+            self._discard()
+            connection = None
+        if connection is None:
+            connection = self._local.connection = self.get_connection()
+            connection.open()
+            self._local.last_used = time.monotonic()
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _discard(self):
+        connection, self._local.connection = self._local.connection, None
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class BatchTransport(Transport):
+    """
+    Base class for the provider HTTP APIs that accept many messages in a single request: subclasses implement
+    send_batch(), which receives up to batch_size messages at a time.
+    """
+    batch_size = 100
+
+    def send_messages(self, messages):
+        sent = 0
+        for i in range(0, len(messages), self.batch_size):
+            sent += self.send_batch(messages[i:i + self.batch_size])
+        return sent
+
+    def send_batch(self, messages):
+        """
+        Args:
+            messages (list[EmailMessage]): at most batch_size messages
+
+        Returns:
+            (int): the number of messages sent
+        """
+        raise NotImplementedError
+
+
+class FakeTransport(Transport):
+    """
+    Keep the messages instead of sending them, waiting latency seconds for each send plus per_message seconds for
+    each message, to load test the app without a mail server.
+    """
+
+    def __init__(self, latency=0.0, per_message=0.0, keep=True):
+        self.latency = latency
+        self.per_message = per_message
+        self.keep = keep
+        self.messages = []
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send_messages(self, messages):
+        time.sleep(self.latency + self.per_message * len(messages))
+        with self._lock:
+            self.sent += len(messages)
+            if self.keep:
+                self.messages.extend(messages)
+        return len(messages)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Return the transport selected by EMAIL_TRANSPORT, the dotted path of a Transport class (or of a callable returning
+    a transport) built with the EMAIL_TRANSPORT_OPTIONS keyword arguments. The transport is created on first use and
+    again after the settings change.
+
+    Returns:
+        (Transport): the transport, a DjangoTransport if the setting is missing
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                config = get_config()
+                factory = import_string(config.transport) if config.transport else DjangoTransport
+                _transport = factory(**(config.transport_options or {}))
+    return _transport
+
+
+def close_transport():
+    """
+    Close the connections of the transport, a new one is created on the next send.
+    """
+    global _transport
+    with _transport_lock:
+        transport, _transport = _transport, None
+    if transport is not None:
+        transport.close()
+
+
+atexit.register(close_transport)
+
+
+@receiver(setting_changed)
+def _reset_transport(*, setting, **kwargs):
+    if setting.startswith('EMAIL_'):
+        close_transport()
@@ -1,17 +1,32 @@
-from django.conf import settings
+import functools
+import re
+
+from django.core.cache import caches
 from django.core.handlers.wsgi import WSGIRequest
+from django.http import HttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.utils.translation import get_language
 
-from .confirm import verify_email_view, verify_email, verify_password_view, verify_password
+from .confirm import verify_email_view, verify_email, verify_password_view, verify_password, averify_email, \
+    averify_password
+from .conf import get_config
 from .errors import NotAllFieldCompiled
 
+# request headers set by the browsers when they prefetch a page
+PREFETCH_HEADERS = (('HTTP_SEC_PURPOSE', 'prefetch'), ('HTTP_PURPOSE', 'prefetch'), ('HTTP_X_MOZ', 'prefetch'),
+                    ('HTTP_X_PURPOSE', 'preview'))
+
 
 @verify_email_view
 def verify(request: WSGIRequest, token):
     try:
-        template = settings.EMAIL_MAIL_PAGE_TEMPLATE
+        template = _get_template(get_config().kinds['MAIL'].page_template, 'EMAIL_MAIL_PAGE_TEMPLATE')
+        if (response := _get_unconfirmed_response(request, token)) is not None:
+            return response
         success, user = verify_email(token)
-        return render(request, template, {'success': success, 'user': user, 'request': request})
+        return _get_result_response(request, template, success, user)
     except (AttributeError, TypeError):
         raise NotAllFieldCompiled('EMAIL_MAIL_PAGE_TEMPLATE field not found')
 
@@ -22,10 +37,115 @@ verify_email_page = verify
 @verify_password_view
 def verify_password_page(request: WSGIRequest, token):
     try:
+        if request.method == 'HEAD':
+            return _never_cache(HttpResponse())
         if request.method == 'POST' and (pwd := request.POST.get('password')) is not None:
             success, user = verify_password(token, pwd)
-            return render(request, settings.EMAIL_PASSWORD_PAGE_TEMPLATE,
-                          {'success': success, 'user': user, 'request': request})
-        return render(request, settings.EMAIL_PASSWORD_CHANGE_PAGE_TEMPLATE, {'token': token, 'request': request})
+            template = _get_template(get_config().kinds['PASSWORD'].page_template, 'EMAIL_PASSWORD_PAGE_TEMPLATE')
+            return _get_result_response(request, template, success, user)
+        template = _get_template(get_config().password_change_page_template, 'EMAIL_PASSWORD_CHANGE_PAGE_TEMPLATE')
+        return _never_cache(render(request, template, {'token': token, 'request': request}))
     except (AttributeError, TypeError):
         raise NotAllFieldCompiled('EMAIL_PASSWORD templates field not found')
+
+
+@verify_email_view
+async def averify_email_page(request, token):
+    try:
+        template = _get_template(get_config().kinds['MAIL'].page_template, 'EMAIL_MAIL_PAGE_TEMPLATE')
+        if (response := _get_unconfirmed_response(request, token)) is not None:
+            return response
+        success, user = await averify_email(token)
+        return await _aget_result_response(request, template, success, user)
+    except (AttributeError, TypeError):
+        raise NotAllFieldCompiled('EMAIL_MAIL_PAGE_TEMPLATE field not found')
+
+
+@verify_password_view
+async def averify_password_page(request, token):
+    try:
+        if request.method == 'HEAD':
+            return _never_cache(HttpResponse())
+        if request.method == 'POST' and (pwd := request.POST.get('password')) is not None:
+            success, user = await averify_password(token, pwd)
+            template = _get_template(get_config().kinds['PASSWORD'].page_template, 'EMAIL_PASSWORD_PAGE_TEMPLATE')
+            return await _aget_result_response(request, template, success, user)
+        template = _get_template(get_config().password_change_page_template, 'EMAIL_PASSWORD_CHANGE_PAGE_TEMPLATE')
+        return _never_cache(render(request, template, {'token': token, 'request': request}))
+    except (AttributeError, TypeError):
+        raise NotAllFieldCompiled('EMAIL_PASSWORD templates field not found')
+
+
+def _get_template(template, field):
+    if template is None:
+        raise NotAllFieldCompiled(f'{field} field not found')
+    return template
+
+
+def is_prefetch(request):
+    """
+    Returns:
+        (bool): True if the request has not been made by the user opening the link: a HEAD request, a browser
+            prefetch or one of the EMAIL_PREFETCH_USER_AGENTS (link previews and mail security scanners)
+    """
+    if request.method == 'HEAD':
+        return True
+    if any(value in request.META.get(header, '').lower() for header, value in PREFETCH_HEADERS):
+        return True
+    agents = _get_agents_pattern(tuple(get_config().prefetch_user_agents))
+    return agents is not None and agents.search(request.META.get('HTTP_USER_AGENT', '')) is not None
+
+
+@functools.lru_cache(maxsize=4)
+def _get_agents_pattern(agents):
+    return re.compile('|'.join(map(re.escape, agents)), re.IGNORECASE) if agents else None
+
+
+def _get_unconfirmed_response(request, token):
+    # the token is consumed only by the user: the prefetches get the confirmation page, or an empty one, and with
+    # EMAIL_MAIL_CONFIRM_PAGE_TEMPLATE the user has to confirm with a POST
+    confirm_template = get_config().mail_confirm_page_template
+    if request.method == 'POST' and confirm_template is not None:
+        return None
+    if not is_prefetch(request) and confirm_template is None:
+        return None
+    if confirm_template is None or request.method == 'HEAD':
+        return _never_cache(HttpResponse())
+    return _never_cache(render(request, confirm_template, {'token': token, 'request': request}))
+
+
+def _get_result_response(request, template, success, user):
+    # the success page shows the user, while the failure page is rendered without the request, so that it is the same
+    # for everyone and can be cached
+    if success or not (timeout := get_config().page_cache_timeout):
+        return _never_cache(render(request, template, {'success': success, 'user': user, 'request': request}))
+    cache, key = _get_page_cache(template)
+    if (content := cache.get(key)) is None:
+        content = render_to_string(template, {'success': False, 'user': None})
+        cache.set(key, content, timeout)
+    return _cached(HttpResponse(content), timeout)
+
+
+async def _aget_result_response(request, template, success, user):
+    # same as _get_result_response(), through the async cache API
+    if success or not (timeout := get_config().page_cache_timeout):
+        return _never_cache(render(request, template, {'success': success, 'user': user, 'request': request}))
+    cache, key = _get_page_cache(template)
+    if (content := await cache.aget(key)) is None:
+        content = render_to_string(template, {'success': False, 'user': None})
+        await cache.aset(key, content, timeout)
+    return _cached(HttpResponse(content), timeout)
+
+
+def _get_page_cache(template):
+    return caches[get_config().token_cache or 'default'], f'django_email_verification:page:{template}:{get_language()}'
+
+
+def _cached(response, timeout):
+    patch_cache_control(response, public=True, max_age=timeout)
+    return response
+
+
+def _never_cache(response):
+    add_never_cache_headers(response)
+    return response